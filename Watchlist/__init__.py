@@ -1,49 +1,149 @@
 import os
 import sys
+import time
 
-from flask import Flask
+from flask import Flask, session
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 
+from Watchlist.assets import Assets
+from Watchlist.cache import Cache
+from Watchlist.database import apply_sqlite_pragmas, engine_options_from_env, sqlite_pragmas_from_env
+from Watchlist.replica import RoutingSession, replica
+from Watchlist.security import hasher
+from Watchlist.warmup import warmup
+
 WIN = sys.platform.startswith('win')
 if WIN:
     prefix = 'sqlite:///' #windows 系统使用///
 else:
     prefix = 'sqlite:////' #否则使用////
 
-app = Flask(__name__)
+# 扩展对象在导入时创建，但不绑定程序实例，由 create_app() 调用 init_app() 完成初始化
+# 这样一个进程中可以创建多个程序实例（例如每个测试使用各自的内存数据库）
+db = SQLAlchemy(session_options={'class_': RoutingSession})  # 配置了只读副本时，GET 请求的查询使用只读连接
+login_manager = LoginManager()
+cache = Cache()
+assets = Assets()
+
+login_manager.login_view = 'main.login' #若未登录用户访问了使用@login_required保护的功能，则回重定向到登录页面
+
+
+def create_app(config=None, with_views=True):
+    """程序工厂函数。
+
+    config 是覆盖默认配置的字典；with_views 为 False 时不导入视图模块，只注册命令行命令，
+    供 ``flask --app "Watchlist:create_app(with_views=False)" import-movies ...`` 这类只需访问数据库的场景使用。
+    """
+    started = time.perf_counter()
+    app = Flask(__name__)
+
+    # 定义签名所需的密钥，加密会话数据，以确保flash函数传递的闪现消息的安全
+    app.config['SECRET_KEY'] = os.getenv('SECRET_KEY','dev')
+    # os.path.dirname()将返回传入路径对应的文件或文件夹的上一级
+    # 把 app.root_path 添加到 os.path.dirname() 中
+    # 以便把文件定位到项目根目录
+    app.config['SQLALCHEMY_DATABASE_URI'] = prefix + os.path.join(os.path.dirname(app.root_path), os.getenv('DATABASE_FILE', 'data.db'))
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # 连接池参数（DATABASE_POOL_SIZE 等环境变量）和每个 SQLite 连接建立时执行的 PRAGMA
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options_from_env()
+    app.config['SQLITE_PRAGMAS'] = sqlite_pragmas_from_env()
+    # 主页每页显示的电影条数，可通过查询参数 per_page 调整，但不超过上限
+    app.config['MOVIES_PER_PAGE'] = int(os.getenv('MOVIES_PER_PAGE', 50))
+    app.config['MOVIES_MAX_PER_PAGE'] = int(os.getenv('MOVIES_MAX_PER_PAGE', 500))
+    # 电影列表片段的缓存时间（秒），数据变化后会因版本号改变而自动失效
+    app.config['PAGE_CACHE_TTL'] = int(os.getenv('PAGE_CACHE_TTL', 300))
+    #是否为 (user_id, title, year) 建立唯一索引，禁止在同一个片单中重复添加同一部电影（flask initdb / flask migrate 时生效）
+    app.config['MOVIE_UNIQUE_TITLE_YEAR'] = os.getenv('MOVIE_UNIQUE_TITLE_YEAR', '0') == '1'
+    # 主页是否默认使用流式输出，以及流式输出时每次从数据库读取的行数和每次发送的最小字符数
+    app.config['INDEX_STREAMING'] = os.getenv('INDEX_STREAMING', '').lower() in ('1', 'true', 'yes', 'on')
+    app.config['STREAM_BATCH_SIZE'] = int(os.getenv('STREAM_BATCH_SIZE', 1000))
+    app.config['STREAM_BUFFER_SIZE'] = int(os.getenv('STREAM_BUFFER_SIZE', 16 * 1024))
+    # 会话存储方式：cookie（默认，Flask 的签名 Cookie）或 server（数据库 + 进程内 LRU，见 Watchlist/sessions.py）
+    app.config['SESSION_BACKEND'] = os.getenv('SESSION_BACKEND', 'cookie')
+    # GET 请求的只读数据来源：primary（只读方式打开主数据库）或 flask snapshot 生成的快照文件路径，默认不启用（见 Watchlist/replica.py）
+    app.config['READ_REPLICA'] = os.getenv('READ_REPLICA') or None
+    # 是否合并主页添加、编辑、删除电影的写操作，在一个事务中批量提交；批次大小和等待时间（秒）见 Watchlist/writes.py
+    app.config['WRITE_COALESCING'] = os.getenv('WRITE_COALESCING', '').lower() in ('1', 'true', 'yes', 'on')
+    app.config['WRITE_BATCH_SIZE'] = int(os.getenv('WRITE_BATCH_SIZE', 64))
+    app.config['WRITE_BATCH_WINDOW'] = float(os.getenv('WRITE_BATCH_WINDOW', 0.002))
+    # flask compile-templates 写出模板字节码缓存的目录，默认在 instance 目录中；启动时是否预先加载模板、配置 ORM 映射，
+    # 默认关闭以免拖慢命令行，wsgi.py 和 asgi.py 中默认开启（见 Watchlist/warmup.py）
+    if os.getenv('TEMPLATE_CACHE_DIR'):
+        app.config['TEMPLATE_CACHE_DIR'] = os.getenv('TEMPLATE_CACHE_DIR')
+    app.config['WARMUP_ON_START'] = os.getenv('WARMUP_ON_START', '').lower() in ('1', 'true', 'yes', 'on')
+    # ASGI 模式（asgi.py）下同步页面使用的线程数，见 Watchlist/aio.py
+    app.config['ASGI_THREADS'] = int(os.getenv('ASGI_THREADS', 32))
+    # JSON API 单个批量请求最多包含的条目数
+    app.config['API_MAX_BATCH'] = int(os.getenv('API_MAX_BATCH', 1000))
+    # 传入的配置在创建数据库引擎之前生效，测试时可以直接使用 sqlite:// 内存数据库
+    if config:
+        app.config.update(config)
 
-# 定义签名所需的密钥，加密会话数据，以确保flash函数传递的闪现消息的安全
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY','dev')
-# os.path.dirname()将返回传入路径对应的文件或文件夹的上一级
-# 把 app.root_path 添加到 os.path.dirname() 中
-# 以便把文件定位到项目根目录
-app.config['SQLALCHEMY_DATABASE_URI'] = prefix + os.path.join(os.path.dirname(app.root_path), os.getenv('DATABASE_FILE', 'data.db'))
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    replica.init_app(app)
+    login_manager.init_app(app)
+    cache.init_app(app)
+    hasher.init_app(app)
+    assets.init_app(app)
+    warmup.init_app(app)
+
+    with app.app_context():
+        for engine in db.engines.values():
+            apply_sqlite_pragmas(engine, app.config['SQLITE_PRAGMAS'])
+
+    # 模型和全文索引模块需要在 create_all() 之前导入，以注册表结构和 DDL 事件
+    from Watchlist import models, search  # noqa: F401
+    from Watchlist.commands import register_commands
+    register_commands(app)
+
+    if with_views:
+        #视图模块只在需要处理请求时才导入
+        from Watchlist.views import main
+        from Watchlist.errors import errors
+        from Watchlist.api import api
+        from Watchlist.compression import compression
+        from Watchlist.metrics import metrics
+        from Watchlist.security import login_limiter
+        from Watchlist.sessions import server_sessions
+        from Watchlist.writes import writes
+        metrics.init_app(app)
+        login_limiter.init_app(app)
+        server_sessions.init_app(app)
+        compression.init_app(app)
+        writes.init_app(app)
+        app.register_blueprint(main)
+        app.register_blueprint(errors)
+        app.register_blueprint(api)
+        app.context_processor(inject_user)
+
+    #第一个请求不再承担模板编译和映射配置的开销，启动耗时写入日志
+    warmup.warm(app, templates=with_views)
+    warmup.finish(app, started)
+    return app
 
-db = SQLAlchemy(app)
-login_manager = LoginManager(app)
 
 @login_manager.user_loader
 # 设置这个函数的目的是
 # 当程序运行后，如果用户已登录，current_user 变量的值会是当前用户的用户模型类记录
 def load_user(user_id):  # 创建用户加载回调函数，接受用户 ID 作为参数
     from Watchlist.models import User
-    user = User.query.get(int(user_id))  # 用 ID 作为 User 模型的主键查询对应的用户
+    #使用服务器端会话时，会话中缓存了已加载的用户对象，直接返回
+    principal = getattr(session, 'principal', None)
+    if principal is not None and principal.id == int(user_id):
+        return principal
+    user = User.get_cached(int(user_id))  # 用 ID 作为 User 模型的主键查询对应的用户，结果会被短暂缓存
+    if hasattr(session, 'principal'):
+        session.principal = user
     return user  # 返回用户对象
 
-login_manager.login_view = 'login' #若未登录用户访问了使用@login_required保护的功能，则回重定向到登录页面
 #模板上下文处理函数，使用字典来储存多个模板内都需要的变量
 #设置该函数后，模板的视图函数中就不需要再指定对应的变量
 #注意base template中的变量一定要使用模板上下文处理函数预先保存
-
-@app.context_processor
 def inject_user():
-    from .models import User
-    user = User.query.first() #读取将User数据库表中的第一行记录对象
+    from .models import current_owner
+    user = current_owner() #当前显示的片单的主人：登录用户本人，或者主用户（带缓存，修改用户后自动失效）
     # 此处应令变量user指向对象user，而非传入对象user的name
     # 因为user可能是个空对象，python对于空对象调用属性会抛出type error，但JinJa2不会，只会返回空字符串
     # 因此无需担心JinJa2中传入空对象的问题
     return dict(user=user)
-
-from Watchlist import views, errors, commands
\ No newline at end of file
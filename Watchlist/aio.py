@@ -0,0 +1,274 @@
+#异步（ASGI）模式：电影 JSON API 在事件循环中处理，其余页面交给原来的 Flask 程序
+#
+#/api/movies 的读写通过 SQLAlchemy 的 asyncio 扩展和 aiosqlite 访问数据库，等待 SQLite 写锁时只挂起协程，不占用线程，
+#一个进程可以同时保持大量连接。请求仍然在 Flask 的请求上下文中处理，before_request / after_request 钩子
+#（登录检查、批量大小限制、指标统计、会话保存）照常执行，只是视图函数换成了下面的异步版本。
+#打开和保存会话、加载用户、执行钩子时可能同步访问数据库，这些步骤放在线程中执行（asyncio.to_thread），不阻塞事件循环。
+#其余页面（主页、编辑、删除、登录等）仍是原来的同步视图，在 ASGI_THREADS 个线程组成的线程池中并发执行，
+#与 gunicorn 的线程模式相同；这些页面的写入可以用 WRITE_COALESCING 合并（见 Watchlist/writes.py）。
+#
+#模型与同步模式完全相同；异步会话注册了与 db.session 相同的事件，写入后同样会更新版本号并让缓存失效。
+#依赖（可选）：pip install aiosqlite，再用任意 ASGI 服务器运行，例如 uvicorn asgi:app
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, jsonify, request, request_started
+from flask_login import current_user
+from sqlalchemy import event, func, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+
+from Watchlist import cache
+from Watchlist.api import (_batch, _error, _results, add_movie, apply_updates, build_movies, delete_ids, movie_to_dict,
+                           pick_deletions, serialize_results, update_ids, update_movie, write_each)
+from Watchlist.database import apply_sqlite_pragmas, begin_immediate
+from Watchlist.models import Movie, current_owner_id, invalidate_cache, reset_changes, track_changes
+from Watchlist.pagination import keyset_query
+
+
+class SyncSession(Session):
+    """AsyncSession 内部使用的同步会话。"""
+
+
+for _name, _listener in (('before_flush', track_changes), ('after_commit', invalidate_cache),
+                         ('after_rollback', reset_changes)):
+    event.listen(SyncSession, _name, _listener)
+
+
+def async_database_uri(uri):
+    #sqlite:///path 换成 aiosqlite 驱动；注意 sqlite:// 内存数据库无法在同步和异步引擎之间共享
+    url = make_url(uri)
+    if url.drivername in ('sqlite', 'sqlite+pysqlite'):
+        url = url.set(drivername='sqlite+aiosqlite')
+    return url
+
+
+async def movie_count(session, user_id):
+    #与 Movie.count() 读主数据库时共用同一个缓存条目（异步引擎总是连接主数据库）
+    key = 'movie_count:%d' % user_id
+    total = cache.get(key)
+    if total is None:
+        total = await session.scalar(select(func.count(Movie.id)).where(Movie.user_id == user_id))
+        cache.set(key, total)
+    return total
+
+
+async def paginate_movies(session, user_id, sort='id', after=None, before=None, per_page=50):
+    query, finish = keyset_query(select(Movie).where(Movie.user_id == user_id), sort, after, before, per_page)
+    return finish((await session.scalars(query)).all())
+
+
+async def _movies_by_id(session, ids):
+    if not ids:
+        return {}
+    query = select(Movie).where(Movie.id.in_(ids), Movie.user_id == current_user.id)
+    return {movie.id: movie for movie in await session.scalars(query)}
+
+
+#以下是 Watchlist/api.py 中视图函数的异步版本，返回值与同步版本相同
+async def list_movies(session):
+    per_page = request.args.get('per_page', current_app.config['MOVIES_PER_PAGE'], type=int)
+    per_page = max(1, min(per_page, current_app.config['MOVIES_MAX_PER_PAGE']))
+    owner_id = await asyncio.to_thread(current_owner_id)  # 未登录时读取主用户，缓存未命中时需要查询
+    page = await paginate_movies(session, owner_id, sort=request.args.get('sort', 'id'),
+                                 after=request.args.get('after'),
+                                 before=request.args.get('before'),
+                                 per_page=per_page)
+    return jsonify(movies=[movie_to_dict(movie) for movie in page.items],
+                   next=page.next_cursor, prev=page.prev_cursor, total=await movie_count(session, owner_id))
+
+
+async def get_movie(session, movie_id):
+    movie = await session.get(Movie, movie_id)
+    if movie is None or movie.user_id != await asyncio.to_thread(current_owner_id):
+        return _error('Movie not found.', 404)
+    return jsonify(movie_to_dict(movie))
+
+
+async def create_movies(session):
+    results = build_movies(_batch('movies'), current_user.id)
+    #逐条写入使用同步 API（SAVEPOINT），在 run_sync 中执行，数据库访问仍然是异步的
+    await session.run_sync(begin_immediate)
+    await session.run_sync(write_each, results, add_movie)
+    await session.commit()
+    return _results(serialize_results(results))
+
+
+async def update_movies(session):
+    items = _batch('movies')
+    await session.run_sync(begin_immediate)
+    results = apply_updates(items, await _movies_by_id(session, update_ids(items)))
+    await session.run_sync(write_each, results, update_movie)
+    await session.commit()
+    return _results(serialize_results(results))
+
+
+async def delete_movies(session):
+    items = _batch('ids')
+    results, deleted = pick_deletions(items, await _movies_by_id(session, delete_ids(items)))
+    for movie in deleted:
+        await session.delete(movie)
+    await session.commit()
+    return _results(results)
+
+
+ASYNC_VIEWS = {
+    'api.list_movies': list_movies,
+    'api.get_movie': get_movie,
+    'api.create_movies': create_movies,
+    'api.update_movies': update_movies,
+    'api.delete_movies': delete_movies,
+}
+
+
+def _environ(scope, body):
+    """根据 ASGI 的 scope 构造 WSGI environ，用来创建 Flask 的请求上下文。"""
+    root_path = scope.get('root_path', '')
+    path = scope['path'][len(root_path):] if scope['path'].startswith(root_path) else scope['path']
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf8').decode('latin1'),
+        'PATH_INFO': path.encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name, value = name.decode('latin1'), value.decode('latin1')
+        if name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        elif name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    environ['CONTENT_LENGTH'] = str(len(body))  # 请求体已经完整读出，分块传输的请求也有确定的长度
+    return environ
+
+
+async def _read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return bytes(body)
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return bytes(body)
+
+
+def _preprocess(app):
+    rv = app.preprocess_request()
+    #Flask-Login 在第一次访问 current_user 时加载用户（缓存未命中时查询），结果保存在 g 中，视图中不再查询
+    current_user._get_current_object()
+    return rv
+
+
+class AsyncApp:
+    """把 Flask 程序包装成 ASGI 程序，电影 API 的视图在事件循环中以异步方式执行。"""
+
+    def __init__(self, app):
+        from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+        self.app = app
+        #同步页面使用的线程池，每个请求从开始到发送完响应占用一个线程
+        self.executor = ThreadPoolExecutor(app.config['ASGI_THREADS'], thread_name_prefix='asgi-wsgi')
+        #ASYNC_DATABASE_URI 默认由 SQLALCHEMY_DATABASE_URI 推导，连接池参数和 PRAGMA 与同步引擎相同
+        self.engine = create_async_engine(
+            app.config.get('ASYNC_DATABASE_URI') or async_database_uri(app.config['SQLALCHEMY_DATABASE_URI']),
+            **app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+        apply_sqlite_pragmas(self.engine.sync_engine, app.config['SQLITE_PRAGMAS'])
+        if 'watchlist_metrics' in app.extensions:
+            from Watchlist.metrics import metrics
+            metrics.watch_engine(self.engine.sync_engine)
+        self.sessionmaker = async_sessionmaker(self.engine, expire_on_commit=False, sync_session_class=SyncSession)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type: %s' % scope['type'])
+        elif scope['path'].startswith('/api/'):
+            await self._dispatch(scope, receive, send)
+        else:
+            await self._wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _wsgi(self, scope, receive, send):
+        body = await _read_body(receive)
+        loop = asyncio.get_running_loop()
+
+        def send_sync(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def run():
+            started = {}
+            def start_response(status, headers, exc_info=None):
+                started['status'] = int(status.split(' ', 1)[0])
+                started['headers'] = [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]
+            chunks = self.app(_environ(scope, body), start_response)
+            try:
+                send_sync({'type': 'http.response.start', **started})
+                #流式响应（主页的 stream 模式）逐块发送
+                for chunk in chunks:
+                    if chunk:
+                        send_sync({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                send_sync({'type': 'http.response.body'})
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+
+        await loop.run_in_executor(self.executor, run)
+
+    async def _dispatch(self, scope, receive, send):
+        app = self.app
+        body = await _read_body(receive)
+        ctx = app.request_context(_environ(scope, body))
+        #会话在推送请求上下文时打开，服务器端会话需要读数据库，这里事先在线程中打开
+        with app.app_context():
+            ctx.session = await asyncio.to_thread(app.session_interface.open_session, app, ctx.request)
+        #与 Flask.full_dispatch_request() 的流程相同，只是视图函数换成了异步版本
+        with ctx:
+            view = ASYNC_VIEWS.get(request.url_rule.endpoint) if request.url_rule else None
+            if view is None:  # 404、405 等由 Flask 直接处理
+                response = await asyncio.to_thread(app.full_dispatch_request)
+            else:
+                try:
+                    try:
+                        request_started.send(app, _async_wrapper=app.ensure_sync)
+                        rv = await asyncio.to_thread(_preprocess, app)
+                        if rv is None:
+                            async with self.sessionmaker() as session:
+                                rv = await view(session, **request.view_args)
+                    except Exception as e:
+                        rv = app.handle_user_exception(e)
+                    response = await asyncio.to_thread(app.finalize_request, rv)  # after_request 中保存会话、压缩响应
+                except Exception as e:
+                    response = app.handle_exception(e)
+            headers = [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in response.headers.items()]
+            data = b'' if scope['method'] == 'HEAD' else response.get_data()
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': data})
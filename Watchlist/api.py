@@ -0,0 +1,217 @@
+#电影数据的 JSON API，支持分页列表和批量创建、修改、删除
+#每个批量请求在一个事务中完成，单个条目失败（包括违反唯一索引）不影响其他条目，结果逐条返回
+from flask import Blueprint, current_app, request, jsonify
+from flask_login import current_user
+from sqlalchemy.exc import IntegrityError
+
+from Watchlist import db
+from Watchlist.database import begin_immediate
+from Watchlist.models import Movie, current_owner_id, movie_is_valid, savepoint
+from Watchlist.pagination import paginate_movies
+
+api = Blueprint('api', __name__, url_prefix='/api')
+
+
+def movie_to_dict(movie):
+    return dict(id=movie.id, title=movie.title, year=movie.year)
+
+
+def _error(message, status):
+    return jsonify(error=message), status
+
+
+def _batch(key):
+    """取出请求体中的条目列表，既可以直接是数组，也可以是 {key: [...]}；格式不对时返回 None。"""
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get(key)
+    return data if isinstance(data, list) else None
+
+
+def _results(results):
+    #全部成功返回 200，部分失败返回 207（Multi-Status）
+    failed = sum(1 for result in results if not result['ok'])
+    return jsonify(results=results, failed=failed), 207 if failed else 200
+
+
+@api.before_request
+def check_request():
+    #读取数据无需登录，写入操作需要已登录的用户
+    if request.method != 'GET' and not current_user.is_authenticated:
+        return _error('Authentication required.', 401)
+    if request.method in ('POST', 'PATCH', 'DELETE'):
+        items = _batch('ids' if request.method == 'DELETE' else 'movies')
+        if items is None:
+            return _error('Expected a JSON array of items.', 400)
+        if len(items) > current_app.config['API_MAX_BATCH']:
+            return _error('Too many items, the limit is %d.' % current_app.config['API_MAX_BATCH'], 413)
+
+
+@api.route('/movies', methods=['GET'])
+def list_movies():
+    per_page = request.args.get('per_page', current_app.config['MOVIES_PER_PAGE'], type=int)
+    per_page = max(1, min(per_page, current_app.config['MOVIES_MAX_PER_PAGE']))
+    owner_id = current_owner_id()
+    page = paginate_movies(owner_id, sort=request.args.get('sort', 'id'),
+                           after=request.args.get('after'),
+                           before=request.args.get('before'),
+                           per_page=per_page)
+    return jsonify(movies=[movie_to_dict(movie) for movie in page.items],
+                   next=page.next_cursor, prev=page.prev_cursor, total=Movie.count(owner_id))
+
+
+@api.route('/movies/<int:movie_id>', methods=['GET'])
+def get_movie(movie_id):
+    movie = Movie.query.filter_by(id=movie_id, user_id=current_owner_id()).first()
+    if movie is None:
+        return _error('Movie not found.', 404)
+    return jsonify(movie_to_dict(movie))
+
+
+def _clean(item, partial=False):
+    """按照视图中的规则校验一个条目，返回 (字段, 错误信息)。partial 为 True 时允许只提供部分字段。"""
+    if not isinstance(item, dict):
+        return None, 'Expected an object.'
+    fields = {}
+    for name in ('title', 'year'):
+        if name in item:
+            fields[name] = str(item[name] if item[name] is not None else '').strip()
+        elif not partial:
+            fields[name] = ''
+    if partial and not fields:
+        return None, 'Nothing to update.'
+    return fields, None
+
+
+#以下几个函数不涉及会话的查询和提交，同步视图和异步模式（Watchlist/aio.py）共用
+def build_movies(items, user_id):
+    """校验待创建的条目，返回逐条结果，通过校验的结果中带有要写入 user_id 的片单的 Movie 对象。"""
+    results = []
+    for index, item in enumerate(items):
+        fields, error = _clean(item)
+        if error is None and not movie_is_valid(fields['title'], fields['year']):
+            error = 'Invalid input.'
+        if error:
+            results.append(dict(index=index, ok=False, error=error))
+            continue
+        fields['year'] = int(fields['year'])
+        results.append(dict(index=index, ok=True, movie=Movie(user_id=user_id, **fields)))
+    return results
+
+
+def add_movie(session, result):
+    session.add(result['movie'])
+
+
+def _update_id(item):
+    #id 可能是任意 JSON 值，列表等不可散列的值也不能用来查找；true/false 是 int 的子类，等于 1/0，同样排除
+    movie_id = item.get('id') if isinstance(item, dict) else None
+    return movie_id if type(movie_id) is int else None
+
+
+def update_ids(items):
+    return [movie_id for movie_id in map(_update_id, items) if movie_id is not None]
+
+
+def apply_updates(items, movies):
+    """校验对已经取出的记录（movies 为 id -> Movie，只包含当前用户的电影）的修改，返回逐条结果。"""
+    results = []
+    for index, item in enumerate(items):
+        fields, error = _clean(item, partial=True)
+        movie = movies.get(_update_id(item)) if error is None else None
+        if error is None and movie is None:
+            error = 'Movie not found.'
+        if error is None and not movie_is_valid(fields.get('title', movie.title), fields.get('year', movie.year)):
+            error = 'Invalid input.'
+        if error:
+            results.append(dict(index=index, ok=False, error=error))
+            continue
+        if 'year' in fields:
+            fields['year'] = int(fields['year'])
+        results.append(dict(index=index, ok=True, movie=movie, changes=fields))
+    return results
+
+
+def update_movie(session, result):
+    for name, value in result.pop('changes').items():
+        setattr(result['movie'], name, value)
+
+
+def write_each(session, results, write):
+    """对通过校验的条目逐条调用 write(session, result)，每条在自己的 SAVEPOINT 中执行。
+
+    违反数据库约束（如 (user_id, title, year) 的唯一索引）的条目只回滚它自己，结果改为失败，其余条目照常写入。
+    """
+    for result in results:
+        if not result['ok']:
+            continue
+        try:
+            with savepoint(session):
+                write(session, result)
+        except IntegrityError as e:
+            del result['movie']
+            result.pop('changes', None)
+            result.update(ok=False, error='This movie is already in the list.' if 'UNIQUE' in str(e.orig) else 'Invalid input.')
+    return results
+
+
+def delete_ids(items):
+    return [item for item in items if type(item) is int]
+
+
+def pick_deletions(items, movies):
+    """返回 (逐条结果, 需要删除的 Movie 对象)，同一个 id 重复出现时只删除一次。"""
+    results, deleted = [], []
+    for index, movie_id in enumerate(items):
+        movie = movies.pop(movie_id, None) if type(movie_id) is int else None
+        if movie is None:
+            results.append(dict(index=index, ok=False, error='Movie not found.'))
+            continue
+        deleted.append(movie)
+        results.append(dict(index=index, ok=True, id=movie_id))
+    return results, deleted
+
+
+def serialize_results(results):
+    #提交后再把 Movie 对象转换成字典，这样新建的记录也能带上 id
+    for result in results:
+        if 'movie' in result:
+            result['movie'] = movie_to_dict(result['movie'])
+    return results
+
+
+def _movies_by_id(ids):
+    if not ids:
+        return {}
+    return {movie.id: movie for movie in Movie.query.filter(Movie.id.in_(ids), Movie.user_id == current_user.id)}
+
+
+@api.route('/movies', methods=['POST'])
+def create_movies():
+    results = build_movies(_batch('movies'), current_user.id)
+    begin_immediate(db.session())
+    write_each(db.session, results, add_movie)
+    db.session.commit()  # 所有写入成功的条目在同一个事务中提交
+    return _results(serialize_results(results))
+
+
+@api.route('/movies', methods=['PATCH'])
+def update_movies():
+    items = _batch('movies')
+    begin_immediate(db.session())  # 读取和修改在同一个写事务中
+    #一次查询取出所有要修改的记录，而不是逐条查询；其他用户的电影视为不存在
+    results = apply_updates(items, _movies_by_id(update_ids(items)))
+    write_each(db.session, results, update_movie)
+    db.session.commit()
+    return _results(serialize_results(results))
+
+
+@api.route('/movies', methods=['DELETE'])
+def delete_movies():
+    items = _batch('ids')
+    movies = _movies_by_id(delete_ids(items))
+    results, deleted = pick_deletions(items, movies)
+    for movie in deleted:
+        db.session.delete(movie)
+    db.session.commit()
+    return _results(results)
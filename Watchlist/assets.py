@@ -0,0 +1,192 @@
+#静态文件的构建和发布：文件名带内容散列、预压缩文本文件、生成缩小的图片和 WebP 版本
+#
+#flask build-assets 把 static 目录中的文件复制到 static/dist 下，文件名中加入内容散列，并写出 manifest.json；
+#程序启动时读取 manifest，url_for('static', filename='style.css') 会生成 dist/style.<散列>.css 这样的地址。
+#文件内容变化后地址随之改变，因此这些文件可以使用一年的 immutable 缓存，浏览器不必再发送条件请求。
+#修改静态文件后需要重新运行 build-assets 并重启程序。
+#brotli 和 Pillow 是可选依赖：没有安装时分别跳过 .br 文件和图片的缩放、WebP 转换。
+#它们只在构建时才导入，程序启动和其他命令不必加载（导入 Pillow 约需 30ms）。
+import gzip
+import hashlib
+import importlib
+import io
+import json
+import mimetypes
+import os
+import shutil
+
+from flask import current_app, request, send_from_directory, url_for
+
+DIST = 'dist'  # 构建结果在 static 目录中的子目录
+TEXT_EXTENSIONS = ('.css', '.js', '.svg', '.txt', '.json', '.html')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))  # 按优先顺序排列
+ONE_YEAR = 365 * 24 * 3600
+
+
+def optional_module(name):
+    """导入可选依赖（如 'brotli'、'PIL.Image'），没有安装时返回 None。"""
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+def _hashed_name(path, data):
+    root, ext = os.path.splitext(path)
+    return '%s.%s%s' % (root, hashlib.sha256(data).hexdigest()[:12], ext)
+
+
+def _write(static_folder, path, data):
+    #文件名由内容决定，已经存在的文件不需要重写
+    target = os.path.join(static_folder, path)
+    if not os.path.exists(target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(data)
+    return path
+
+
+def _compress(static_folder, path, data, brotli):
+    """为文本文件写出 .gz 和 .br 版本（brotli 为 None 时只写 .gz），返回生成的编码列表。"""
+    encodings = []
+    for encoding, ext in ENCODINGS:
+        if encoding == 'br':
+            if brotli is None:
+                continue
+            compressed = brotli.compress(data, quality=11)
+        else:
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)  # mtime 固定，重复构建的结果相同
+        if len(compressed) < len(data):
+            _write(static_folder, path + ext, compressed)
+            encodings.append(encoding)
+    return encodings
+
+
+def _image_variants(static_folder, name, path, widths, quality, Image):
+    """生成各宽度的缩小版本（不放大）以及对应的 WebP 版本，原图本身也作为一个版本列出。"""
+    root, ext = os.path.splitext(name)
+    mimetype = mimetypes.guess_type(name)[0]
+    with Image.open(os.path.join(static_folder, name)) as image:
+        image.load()
+        original_width = image.width
+        variants = []
+        alpha = image.mode in ('RGBA', 'LA', 'P')
+        for width in [w for w in widths if w < original_width] + [original_width]:
+            resized = image if width == original_width else \
+                image.resize((width, round(image.height * width / original_width)), Image.LANCZOS)
+            formats = [('image/webp', '.webp', 'WEBP')]
+            if width != original_width:
+                formats.insert(0, (mimetype, ext, image.format))
+            for variant_type, variant_ext, fmt in formats:
+                buffer = io.BytesIO()
+                mode = 'RGBA' if alpha and fmt != 'JPEG' else 'RGB'
+                resized.convert(mode).save(buffer, fmt, quality=quality, optimize=True)
+                data = buffer.getvalue()
+                variant = _hashed_name('%s/%s.%dw%s' % (DIST, root, width, variant_ext), data)
+                variants.append(dict(path=_write(static_folder, variant, data), width=width, type=variant_type))
+    variants.append(dict(path=path, width=original_width, type=mimetype))
+    return variants
+
+
+def build_assets(static_folder, widths=(80, 160, 320), quality=80, clean=False):
+    """构建 static_folder 中的全部文件，写出 manifest 并返回其内容。"""
+    dist = os.path.join(static_folder, DIST)
+    if clean and os.path.isdir(dist):
+        shutil.rmtree(dist)
+    manifest = {'files': {}, 'encodings': {}, 'images': {}}
+    brotli, Image = optional_module('brotli'), optional_module('PIL.Image')
+    for directory, dirnames, filenames in os.walk(static_folder):
+        if os.path.abspath(directory) == os.path.abspath(static_folder):
+            dirnames[:] = [d for d in dirnames if d != DIST]
+        for filename in sorted(filenames):
+            source = os.path.join(directory, filename)
+            name = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+            path = _write(static_folder, _hashed_name(DIST + '/' + name, data), data)
+            manifest['files'][name] = path
+            ext = os.path.splitext(name)[1].lower()
+            if ext in TEXT_EXTENSIONS:
+                encodings = _compress(static_folder, path, data, brotli)
+                if encodings:
+                    manifest['encodings'][path] = encodings
+            elif ext in IMAGE_EXTENSIONS and Image is not None:
+                manifest['images'][name] = _image_variants(static_folder, name, path, widths, quality, Image)
+    with open(os.path.join(dist, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(static_folder):
+    """读取构建结果，尚未构建时返回 None。"""
+    path = os.path.join(static_folder, DIST, 'manifest.json')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        data = f.read()
+    manifest = json.loads(data)
+    #构建结果的校验和，重新构建后随之改变，页面的 ETag 包含它（见 views.index）
+    manifest['hash'] = hashlib.sha256(data).hexdigest()[:12]
+    #构建生成的所有文件，这些文件使用长期缓存
+    manifest['built'] = set(manifest['files'].values())
+    for variants in manifest['images'].values():
+        manifest['built'].update(variant['path'] for variant in variants)
+    return manifest
+
+
+class Assets:
+    """Flask 扩展：读取 build-assets 生成的 manifest，改写静态文件地址，并为构建后的文件设置长期缓存。"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ASSET_IMAGE_WIDTHS', (80, 160, 320))  # 生成的图片宽度（像素），不会超过原图宽度
+        app.config.setdefault('ASSET_IMAGE_QUALITY', 80)
+        #尚未构建时 manifest 为 None，以下钩子保持 Flask 默认的行为
+        app.extensions['watchlist_assets'] = load_manifest(app.static_folder)
+        app.url_defaults(self._rewrite_url)
+        app.view_functions['static'] = self._send_static
+        app.add_template_global(self.srcset, 'asset_srcset')
+
+    @staticmethod
+    def _rewrite_url(endpoint, values):
+        manifest = current_app.extensions['watchlist_assets']
+        if endpoint == 'static' and manifest is not None:
+            values['filename'] = manifest['files'].get(values.get('filename'), values.get('filename'))
+
+    @staticmethod
+    def _send_static(filename):
+        manifest = current_app.extensions['watchlist_assets']
+        if manifest is None or filename not in manifest['built']:
+            return current_app.send_static_file(filename)
+        #客户端支持时直接发送预先压缩好的文件
+        encodings = manifest['encodings'].get(filename, ())
+        for encoding, ext in ENCODINGS:
+            if encoding in encodings and request.accept_encodings[encoding]:
+                response = send_from_directory(current_app.static_folder, filename + ext,
+                                               mimetype=mimetypes.guess_type(filename)[0])
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = current_app.send_static_file(filename)
+        if encodings:
+            response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.max_age = ONE_YEAR
+        response.cache_control.immutable = True
+        return response
+
+    @staticmethod
+    def srcset(filename, mimetype=None):
+        """返回图片各个版本组成的 srcset 属性值；未构建或没有该类型的版本时返回空字符串。"""
+        manifest = current_app.extensions['watchlist_assets']
+        variants = manifest['images'].get(filename, ()) if manifest else ()
+        mimetype = mimetype or mimetypes.guess_type(filename)[0]
+        return ', '.join('%s %dw' % (url_for('static', filename=variant['path']), variant['width'])
+                         for variant in variants if variant['type'] == mimetype)
+
+
+assets = Assets()
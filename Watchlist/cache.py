@@ -0,0 +1,90 @@
+#进程内缓存，用于保存查询结果（如电影总数），避免每次请求都访问数据库
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+
+class TTLCache:
+    """带过期时间（TTL）和容量上限（LRU 淘汰）的线程安全缓存。"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # key -> (过期时间, 值)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires, value = item
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]  # 已过期，直接丢弃
+                return default
+            self._data.move_to_end(key)  # 最近使用的条目移到末尾
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)  # 淘汰最久未使用的条目
+
+    def get_or_set(self, key, factory, ttl=None):
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.set(key, value, ttl)
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._data if isinstance(k, str) and k.startswith(prefix)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class Cache:
+    """按 Flask 扩展的方式使用：每个程序实例拥有自己的 TTLCache。"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_MAXSIZE', 1024)
+        app.config.setdefault('CACHE_TTL', 5)  #秒，多个 worker 之间的缓存最多不一致这么久
+        app.extensions['watchlist_cache'] = TTLCache(app.config['CACHE_MAXSIZE'])
+
+    @property
+    def store(self):
+        return current_app.extensions['watchlist_cache']
+
+    def get(self, key, default=None):
+        return self.store.get(key, default)
+
+    def set(self, key, value, ttl=None):
+        self.store.set(key, value, current_app.config['CACHE_TTL'] if ttl is None else ttl)
+
+    def get_or_set(self, key, factory, ttl=None):
+        return self.store.get_or_set(key, factory, current_app.config['CACHE_TTL'] if ttl is None else ttl)
+
+    def delete(self, key):
+        self.store.delete(key)
+
+    def delete_prefix(self, prefix):
+        self.store.delete_prefix(prefix)
+
+    def clear(self):
+        self.store.clear()
@@ -1,9 +1,21 @@
+import csv
+import json
+import time
+from itertools import islice
+
 import click
+from flask import current_app
+from flask.cli import with_appcontext
 
-from Watchlist import app, db
-from Watchlist.models import User, Movie
+from Watchlist import db, migrations
+from Watchlist.assets import build_assets, optional_module
+from Watchlist.models import User, Movie, mark_changed, movie_is_valid
+from Watchlist.replica import snapshot as take_snapshot
+from Watchlist.search import create_index
+from Watchlist.warmup import compile_templates
 
-@app.cli.command() #将以下的函数注册为flask命令，功能为初始化数据库
+@click.command() #将以下的函数注册为flask命令（见 register_commands），功能为初始化数据库
+@with_appcontext
 @click.option('--drop', is_flag=True, help='Create after drop.') 
 def initdb(drop):
     #"Initialize the database"
@@ -11,42 +23,132 @@ def initdb(drop):
         db.drop_all()
         click.echo('Successfully deleted the current database.')
     db.create_all()
+    #旧数据库的表结构先迁移到最新，之后才能按当前的模型补建索引
+    _upgrade(unique=current_app.config['MOVIE_UNIQUE_TITLE_YEAR'])
+    # create_all 不会为已存在的表补建索引，这里逐个检查并创建
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    if create_index():
+        click.echo('Built the full-text search index.')
     click.echo('Initialized database.')
 
-@app.cli.command()#将以下的函数注册为flask命令，功能为添加虚拟数据
+def _upgrade(**options):
+    if db.engine.dialect.name != 'sqlite':
+        return
+    db.session.remove()  # 迁移使用独立的连接，先结束当前会话中的事务
+    try:
+        migrations.upgrade(echo=click.echo, **options)
+    except migrations.MigrationError as e:
+        raise click.ClickException(str(e))
+
+#迁移数据库结构，大表按批复制，迁移期间程序可以继续读写（见 Watchlist/migrations.py）
+@click.command()
+@with_appcontext
+@click.option('--unique', is_flag=True, help='Also add the unique index on (user_id, title, year).')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows copied per transaction.')
+@click.option('--pause', default=0.0, show_default=True, help='Seconds to sleep between batches.')
+@click.option('--drop-invalid', is_flag=True, help='Drop rows that violate the new constraints instead of aborting.')
+@click.option('--status', 'show_status', is_flag=True, help='List the migrations and exit.')
+def migrate(unique, batch_size, pause, drop_invalid, show_status):
+    """Upgrade the database schema."""
+    if show_status:
+        for name, description, done, optional in migrations.status():
+            click.echo('[%s] %s - %s%s' % ('x' if done else ' ', name, description, ' (optional)' if optional else ''))
+        return
+    _upgrade(unique=unique or current_app.config['MOVIE_UNIQUE_TITLE_YEAR'],
+             batch_size=batch_size, pause=pause, drop_invalid=drop_invalid)
+    click.echo('Database is up to date.')
+
+#用 SQLite 在线备份 API 生成一致的数据库快照，可以作为只读副本（READ_REPLICA）使用，也可以用于备份
+@click.command('snapshot')
+@with_appcontext
+@click.argument('dest', type=click.Path(dir_okay=False))
+@click.option('--pages', default=-1, show_default=True, help='Pages copied per step, -1 copies everything in one read transaction.')
+@click.option('--pause', default=0.0, show_default=True, help='Seconds to sleep between steps.')
+@click.option('--every', type=float, help='Keep running and refresh the snapshot every N seconds.')
+def snapshot_command(dest, pages, pause, every):
+    """Write a consistent copy of the database to DEST."""
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException('Snapshots are only supported for SQLite databases.')
+    while True:
+        start = time.perf_counter()
+        progress = []
+        take_snapshot(db.engine, dest, pages=pages, pause=pause,
+                      progress=lambda status, remaining, total: progress.append(total))
+        click.echo('Snapshot written to %s (%d pages) in %.2fs.'
+                   % (dest, progress[-1] if progress else 0, time.perf_counter() - start))
+        if not every:
+            break
+        time.sleep(every)
+
+#构建静态文件：文件名加入内容散列，预压缩文本文件，生成缩小的图片和 WebP 版本（见 Watchlist/assets.py）
+@click.command('build-assets')
+@with_appcontext
+@click.option('--clean', is_flag=True, help='Remove previously built files first.')
+def build_assets_command(clean):
+    """Fingerprint, precompress and resize the static files."""
+    manifest = build_assets(current_app.static_folder, widths=current_app.config['ASSET_IMAGE_WIDTHS'],
+                            quality=current_app.config['ASSET_IMAGE_QUALITY'], clean=clean)
+    click.echo('Built %d files, %d precompressed, %d image variants.' % (
+        len(manifest['files']), len(manifest['encodings']),
+        sum(len(variants) - 1 for variants in manifest['images'].values())))
+    #build_assets 已经尝试导入过，这里不会重复加载
+    if optional_module('brotli') is None:
+        click.echo('brotli is not installed, skipped .br files.')
+    if optional_module('PIL.Image') is None:
+        click.echo('Pillow is not installed, skipped resized and WebP images.')
+    click.echo('Restart the application to serve the new files.')
+
+#预编译全部模板，写入 Jinja 字节码缓存，新启动的 worker 不必在处理请求时编译模板（见 Watchlist/warmup.py）
+@click.command('compile-templates')
+@with_appcontext
+@click.option('--clean', is_flag=True, help='Remove previously compiled templates first.')
+def compile_templates_command(clean):
+    """Precompile the Jinja templates into the bytecode cache."""
+    directory = current_app.config['TEMPLATE_CACHE_DIR']
+    start = time.perf_counter()
+    names = compile_templates(current_app.jinja_env, directory, clean=clean)
+    click.echo('Compiled %d templates into %s in %.2fs.' % (len(names), directory, time.perf_counter() - start))
+    click.echo('Restart the application to load the cache.')
+
+@click.command()#将以下的函数注册为flask命令，功能为添加虚拟数据
+@with_appcontext
 def forge():
     # Generate fake data
     db.create_all()
     name = 'ZHS'
     movies = [
-        {'title': 'My Neighbor Totoro', 'year': '1988'},
-        {'title': 'Dead Poets Society', 'year': '1989'},
-        {'title': 'A Perfect World', 'year': '1993'},
-        {'title': 'Leon', 'year': '1994'},
-        {'title': 'Mahjong', 'year': '1996'},
-        {'title': 'Swallowtail Butterfly', 'year': '1996'},
-        {'title': 'King of Comedy', 'year': '1999'},
-        {'title': 'Devils on the Doorstep', 'year': '1999'},
-        {'title': 'WALL-E', 'year': '2008'},
-        {'title': 'The Pork of Music', 'year': '2012'},
+        {'title': 'My Neighbor Totoro', 'year': 1988},
+        {'title': 'Dead Poets Society', 'year': 1989},
+        {'title': 'A Perfect World', 'year': 1993},
+        {'title': 'Leon', 'year': 1994},
+        {'title': 'Mahjong', 'year': 1996},
+        {'title': 'Swallowtail Butterfly', 'year': 1996},
+        {'title': 'King of Comedy', 'year': 1999},
+        {'title': 'Devils on the Doorstep', 'year': 1999},
+        {'title': 'WALL-E', 'year': 2008},
+        {'title': 'The Pork of Music', 'year': 2012},
     ]
     user = User(name=name)
     db.session.add(user)
+    db.session.flush()  # 分配 user.id
     for m in movies:
-        movie = Movie(title=m['title'], year=m['year'])
+        movie = Movie(title=m['title'], year=m['year'], user_id=user.id)
         db.session.add(movie)
     db.session.commit()
     click.echo('Done.')
 
-#创建管理员账户
-@app.cli.command()
+#创建管理员账户，即主用户（id 最小的用户），未登录的访客看到的是他的片单
+@click.command()
+@with_appcontext
 @click.option('--username', prompt=True, help='The username used to login.')
 @click.option('--password', prompt=True, hide_input=True, confirmation_prompt=True, help='The password used to login.')
 def admin(username, password):
     """Create user."""
     db.create_all()
 
-    user = User.query.first()
+    user = User.query.order_by(User.id).first()
     if user is not None:
         click.echo('Updating user...')
         user.username = username
@@ -57,4 +159,146 @@ def admin(username, password):
         user.set_password(password) #设置密码
         db.session.add(user)
     db.session.commit() #提交数据库会话
-    click.echo('Done.')
\ No newline at end of file
+    click.echo('Done.')
+
+#添加其他用户，每个用户有自己的片单
+@click.command('add-user')
+@with_appcontext
+@click.option('--username', prompt=True, help='The username used to login.')
+@click.option('--name', help='Display name, defaults to the username.')
+@click.option('--password', prompt=True, hide_input=True, confirmation_prompt=True, help='The password used to login.')
+def add_user(username, name, password):
+    """Add another user with an empty watchlist."""
+    db.create_all()
+    if not username or len(username) > 20:
+        raise click.ClickException('The username must be 1-20 characters long.')
+    if User.query.filter_by(username=username).first() is not None:
+        raise click.ClickException('User %s already exists.' % username)
+    user = User(username=username, name=(name or username)[:20])
+    user.set_password(password)
+    db.session.add(user)
+    db.session.commit()
+    click.echo('Created user %s.' % username)
+
+def _find_user(username):
+    #没有指定用户名时使用主用户
+    query = User.query.filter_by(username=username) if username else User.query.order_by(User.id)
+    user = query.first()
+    if user is None:
+        raise click.ClickException('User %s does not exist.' % username if username else
+                                   'There are no users yet, create one with flask admin.')
+    return user
+
+
+def _guess_format(file, fmt):
+    #未指定格式时根据文件扩展名判断，默认为 CSV
+    if fmt:
+        return fmt
+    name = getattr(file, 'name', '') or ''
+    return 'jsonl' if name.endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+def _read_rows(file, fmt):
+    #逐行读取，始终只在内存中保留当前这一行；JSON 格式错误或不是对象的行返回 None，作为无效的行跳过
+    if fmt == 'csv':
+        for row in csv.DictReader(file):
+            yield row
+    else:
+        for line in file:
+            line = line.strip()
+            if line:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+                yield row if isinstance(row, dict) else None
+
+#批量导入电影数据，支持 CSV（带 title,year 表头）和 JSON Lines 格式
+@click.command('import-movies')
+@with_appcontext
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Input format, guessed from the file name by default.')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows sent to the database per executemany call.')
+@click.option('--commit-size', default=50000, show_default=True, help='Rows written per transaction.')
+@click.option('--username', help='Whose watchlist to import into, defaults to the admin user.')
+def import_movies(source, fmt, batch_size, commit_size, username):
+    """Import movies from a CSV or JSON Lines file ('-' for stdin)."""
+    db.create_all()
+    user_id = _find_user(username).id
+    fmt = _guess_format(source, fmt)
+    rows = _read_rows(source, fmt)
+    #每行仍用 movie_is_valid 校验：INTEGER 列会把 '1e3'、'2019.0' 这样的文本转换成整数，CHECK 约束拦不住；
+    #表上有约束时使用 OR IGNORE，违反唯一索引等约束的行被忽略而不是中断导入
+    statement = db.insert(Movie.__table__)  # Core 语句，执行结果带有 rowcount
+    if migrations.year_is_integer():
+        statement = statement.prefix_with('OR IGNORE')
+    imported = skipped = pending = 0
+    start = time.perf_counter()
+    while True:
+        #每次只从输入流中取出一批数据，内存占用与文件大小无关
+        chunk = list(islice(rows, batch_size))
+        if not chunk:
+            break
+        batch = []
+        for row in chunk:
+            if row is None:
+                skipped += 1
+                continue
+            title = str(row.get('title') or '').strip()
+            year = str(row.get('year') or '').strip()
+            if movie_is_valid(title, year):
+                batch.append({'title': title, 'year': int(year), 'user_id': user_id})
+            else:
+                skipped += 1
+        if not batch:
+            continue
+        #使用 executemany 批量插入，不创建 ORM 对象
+        count = db.session.execute(statement, batch).rowcount
+        skipped += len(batch) - count
+        imported += count
+        pending += count
+        if pending >= commit_size:
+            mark_changed(db.session, Movie)
+            db.session.commit()
+            pending = 0
+    if pending:
+        mark_changed(db.session, Movie)
+        db.session.commit()
+    elapsed = time.perf_counter() - start
+    click.echo('Imported %d movies, skipped %d invalid rows in %.2fs (%.0f rows/sec).'
+               % (imported, skipped, elapsed, imported / elapsed if elapsed else imported))
+
+#导出电影数据，使用服务器端游标分批读取，导出任意规模的数据都只占用固定的内存
+@click.command('export-movies')
+@with_appcontext
+@click.argument('dest', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Output format, guessed from the file name by default.')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows fetched from the database at a time.')
+@click.option('--username', help='Only export this user\'s watchlist.')
+def export_movies(dest, fmt, batch_size, username):
+    """Export movies to a CSV or JSON Lines file (stdout by default)."""
+    fmt = _guess_format(dest, fmt)
+    query = db.select(Movie.id, Movie.title, Movie.year).order_by(Movie.id).execution_options(yield_per=batch_size)
+    if username:
+        query = query.where(Movie.user_id == _find_user(username).id)
+    exported = 0
+    start = time.perf_counter()
+    writer = None
+    if fmt == 'csv':
+        writer = csv.writer(dest)
+        writer.writerow(['id', 'title', 'year'])
+    for row in db.session.execute(query):
+        if writer is not None:
+            writer.writerow(row)
+        else:
+            dest.write(json.dumps(row._asdict(), ensure_ascii=False) + '\n')
+        exported += 1
+    elapsed = time.perf_counter() - start
+    #统计信息输出到标准错误，避免混入导出到标准输出的数据
+    click.echo('Exported %d movies in %.2fs (%.0f rows/sec).'
+               % (exported, elapsed, exported / elapsed if elapsed else exported), err=True)
+
+
+def register_commands(app):
+    for command in (initdb, migrate, snapshot_command, build_assets_command, compile_templates_command,
+                    forge, admin, add_user, import_movies, export_movies):
+        app.cli.add_command(command)
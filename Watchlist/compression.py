@@ -0,0 +1,106 @@
+#响应压缩：根据 Accept-Encoding 使用 brotli 或 gzip 压缩文本类型的响应
+#
+#普通响应小于 COMPRESS_MIN_SIZE 时不压缩（压缩后的收益抵不上开销）；带 ETag 的响应，其压缩结果按 ETag 缓存，
+#例如主页的 ETag 由数据版本、登录用户和分页参数决定，同样的页面再次访问时直接使用缓存的压缩结果。
+#流式响应逐块压缩，每块之后都刷新压缩器，浏览器可以边接收边渲染。
+#brotli 是可选依赖，没有安装时只使用 gzip。
+import zlib
+
+from flask import current_app, request
+
+from Watchlist import cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _gzip_stream(chunks, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 表示 gzip 格式
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _brotli_stream(chunks, quality):
+    compressor = brotli.Compressor(quality=quality)
+    for chunk in chunks:
+        data = compressor.process(chunk) + compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+class Compression:
+    """Flask 扩展：在 after_request 中压缩响应。"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COMPRESS_ENABLED', True)
+        app.config.setdefault('COMPRESS_MIN_SIZE', 500)  # 字节
+        app.config.setdefault('COMPRESS_GZIP_LEVEL', 6)
+        app.config.setdefault('COMPRESS_BROTLI_QUALITY', 4)  # 动态内容使用较低的质量，11 只适合预先压缩的静态文件
+        app.config.setdefault('COMPRESS_MIMETYPES', ('text/html', 'text/css', 'text/plain', 'text/xml',
+                                                     'application/json', 'application/javascript', 'image/svg+xml'))
+        app.after_request(self._compress)
+
+    @staticmethod
+    def _choose_encoding():
+        #优先使用 brotli，客户端对两者的权重不同时按权重选择
+        accepted = request.accept_encodings
+        candidates = [('br', accepted['br'])] if brotli is not None else []
+        candidates.append(('gzip', accepted['gzip']))
+        encoding, quality = max(candidates, key=lambda item: item[1])
+        return encoding if quality else None
+
+    def _compress(self, response):
+        config = current_app.config
+        if (not config['COMPRESS_ENABLED']
+                or request.method == 'HEAD'
+                or response.status_code < 200 or response.status_code in (204, 206, 304)
+                or response.direct_passthrough  # send_file 发送的文件，包括预先压缩好的静态文件
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in config['COMPRESS_MIMETYPES']
+                or response.cache_control.no_transform):
+            return response
+        response.vary.add('Accept-Encoding')  # 是否压缩取决于该请求头，缓存需要区分
+        encoding = self._choose_encoding()
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            chunks = (chunk.encode() if isinstance(chunk, str) else chunk for chunk in response.response)
+            if encoding == 'br':
+                response.response = _brotli_stream(chunks, config['COMPRESS_BROTLI_QUALITY'])
+            else:
+                response.response = _gzip_stream(chunks, config['COMPRESS_GZIP_LEVEL'])
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < config['COMPRESS_MIN_SIZE']:
+                return response
+            etag, weak = response.get_etag()
+            key = 'compressed:%s:%s:%s' % (encoding, request.full_path, etag) if etag else None
+            compressed = cache.get(key) if key else None
+            if compressed is None:
+                if encoding == 'br':
+                    compressed = brotli.compress(data, quality=config['COMPRESS_BROTLI_QUALITY'])
+                else:
+                    compressed = zlib.compress(data, config['COMPRESS_GZIP_LEVEL'], wbits=31)
+                if key:
+                    cache.set(key, compressed, config['PAGE_CACHE_TTL'])
+            response.set_data(compressed)
+            #强 ETag 表示逐字节相同，压缩后的内容需要不同的 ETag；弱 ETag 保持不变
+            if etag and not weak:
+                response.set_etag('%s-%s' % (etag, encoding))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+
+compression = Compression()
@@ -0,0 +1,62 @@
+#数据库连接相关的配置：连接池参数和 SQLite 的 PRAGMA 设置
+import os
+
+from sqlalchemy import event
+
+# 连接池参数与环境变量的对应关系，只有设置了环境变量的参数才会传给 create_engine()
+POOL_OPTIONS = (
+    ('pool_size', 'DATABASE_POOL_SIZE', int),
+    ('max_overflow', 'DATABASE_MAX_OVERFLOW', int),
+    ('pool_timeout', 'DATABASE_POOL_TIMEOUT', float),
+    ('pool_recycle', 'DATABASE_POOL_RECYCLE', int),
+    ('pool_pre_ping', 'DATABASE_POOL_PRE_PING', lambda value: value.lower() in ('1', 'true', 'yes', 'on')),
+)
+
+
+def engine_options_from_env():
+    options = {}
+    for key, env, convert in POOL_OPTIONS:
+        value = os.getenv(env)
+        if value:
+            options[key] = convert(value)
+    return options
+
+
+def sqlite_pragmas_from_env():
+    #busy_timeout 放在最前面，这样切换 WAL 等需要加锁的操作也会等待而不是立即报错
+    return {
+        'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000)),  # 毫秒
+        'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),  # WAL 模式下读写互不阻塞
+        'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),  # WAL 模式下 NORMAL 已足够安全，且不必每次提交都 fsync
+        'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),  # 字节
+        'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', -64000)),  # 负数表示 KiB，即 64MB
+    }
+
+
+def begin_immediate(session):
+    """在 SQLite 上为 session（Session 对象，不是 db.session 这样的 scoped_session）显式开始写事务；其他数据库不做任何事。
+
+    pysqlite 不会在 SAVEPOINT 之前开始事务，第一个 SAVEPOINT 释放时就会提交；手动开始事务后，
+    begin_nested() 才是真正嵌套在事务中的保存点，session.commit() 时一起提交。
+    IMMEDIATE 在开始时就取得写锁，避免执行到一半才发现数据库被锁。
+    """
+    if session.get_bind().dialect.name == 'sqlite':
+        if session.in_transaction():
+            #先结束之前的只读事务（例如加载当前用户的查询），连接归还连接池，重新取出时才能设置执行选项
+            session.commit()
+        session.connection(execution_options={'isolation_level': 'AUTOCOMMIT'}).exec_driver_sql('BEGIN IMMEDIATE')
+
+
+def apply_sqlite_pragmas(engine, pragmas):
+    """在引擎每次建立新的 SQLite 连接时执行给定的 PRAGMA。"""
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute('PRAGMA %s = %s' % (name, value))
+        finally:
+            cursor.close()
@@ -1,8 +1,9 @@
-from flask import render_template
-from Watchlist import app
+from flask import Blueprint, render_template
+
+errors = Blueprint('errors', __name__)
 
 #错误页面
-@app.errorhandler(404)
+@errors.app_errorhandler(404)
 def page_not_found(e):
     #user = User.query.first()
     return render_template('errors/404.html'), 404
\ No newline at end of file
@@ -0,0 +1,169 @@
+#按端点统计每个请求的耗时、SQL 查询次数与耗时、模板渲染耗时，并以 Prometheus 文本格式输出到 /metrics
+#统计数据保存在当前进程中，多个 worker 时需要分别采集
+import threading
+import time
+from collections import defaultdict
+
+from flask import Response, before_render_template, current_app, g, has_request_context, request, template_rendered
+from sqlalchemy import event
+
+from Watchlist import db
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 每个请求的查询次数分布，N+1 查询会让请求落到靠后的区间
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def lines(self, name, labels):
+        for bound, count in zip(self.buckets, self.counts):
+            yield '%s_bucket{%s,le="%s"} %d' % (name, labels, bound, count)
+        yield '%s_bucket{%s,le="+Inf"} %d' % (name, labels, self.count)
+        yield '%s_sum{%s} %s' % (name, labels, self.sum)
+        yield '%s_count{%s} %d' % (name, labels, self.count)
+
+
+class EndpointStats:
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.responses = defaultdict(int)  # (方法, 状态码) -> 次数
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+
+
+class Metrics:
+    """Flask 扩展：记录请求指标并注册 /metrics 端点。"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_SERVER_TIMING', False)  # 是否在响应中附带 Server-Timing 头
+        state = app.extensions['watchlist_metrics'] = {'lock': threading.Lock(), 'endpoints': defaultdict(EndpointStats)}
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.add_url_rule('/metrics', 'metrics', lambda: Response(self.render(state, app.extensions.get('watchlist_warmup')),
+                                                                 mimetype='text/plain; version=0.0.4'))
+        before_render_template.connect(self._start_template, app)
+        template_rendered.connect(self._finish_template, app)
+        with app.app_context():
+            for engine in db.engines.values():
+                self.watch_engine(engine)
+        if 'watchlist_replica' in app.extensions:
+            self.watch_engine(app.extensions['watchlist_replica']['engine'])
+
+    def watch_engine(self, engine):
+        #统计该引擎执行的 SQL；异步模式的引擎传入其 sync_engine
+        event.listen(engine, 'before_cursor_execute', self._start_query)
+        event.listen(engine, 'after_cursor_execute', self._finish_query)
+
+    @staticmethod
+    def _start_request():
+        g.metrics = {'start': time.perf_counter(), 'queries': 0, 'sql': 0.0, 'template': 0.0}
+
+    @staticmethod
+    def _start_query(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @staticmethod
+    def _finish_query(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        #命令行等请求之外执行的查询不计入
+        if has_request_context() and 'metrics' in g:
+            g.metrics['queries'] += 1
+            g.metrics['sql'] += elapsed
+
+    @staticmethod
+    def _start_template(sender, template, context, **extra):
+        if 'metrics' in g:
+            g.metrics.setdefault('template_start', []).append(time.perf_counter())
+
+    @staticmethod
+    def _finish_template(sender, template, context, **extra):
+        if 'metrics' in g and g.metrics.get('template_start'):
+            g.metrics['template'] += time.perf_counter() - g.metrics['template_start'].pop()
+
+    def _finish_request(self, response):
+        current = g.pop('metrics', None)
+        if current is None:
+            return response
+        elapsed = time.perf_counter() - current['start']
+        endpoint = request.endpoint or 'none'
+        state = current_app.extensions['watchlist_metrics']
+        with state['lock']:
+            stats = state['endpoints'][endpoint]
+            stats.latency.observe(elapsed)
+            stats.queries.observe(current['queries'])
+            stats.responses[(request.method, response.status_code)] += 1
+            stats.sql_queries += current['queries']
+            stats.sql_seconds += current['sql']
+            stats.template_seconds += current['template']
+        if current_app.config['METRICS_SERVER_TIMING']:
+            response.headers['Server-Timing'] = 'app;dur=%.2f, db;dur=%.2f;desc="%d queries", tpl;dur=%.2f' % (
+                elapsed * 1000, current['sql'] * 1000, current['queries'], current['template'] * 1000)
+        return response
+
+    @staticmethod
+    def render(state, startup=None):
+        with state['lock']:
+            endpoints = sorted(state['endpoints'].items())
+            lines = [
+                '# HELP watchlist_requests_total Requests handled, by endpoint, method and status.',
+                '# TYPE watchlist_requests_total counter',
+            ]
+            for endpoint, stats in endpoints:
+                for (method, status), count in sorted(stats.responses.items()):
+                    lines.append('watchlist_requests_total{endpoint="%s",method="%s",status="%d"} %d'
+                                 % (endpoint, method, status, count))
+            lines += [
+                '# HELP watchlist_request_duration_seconds Request latency.',
+                '# TYPE watchlist_request_duration_seconds histogram',
+            ]
+            for endpoint, stats in endpoints:
+                lines.extend(stats.latency.lines('watchlist_request_duration_seconds', 'endpoint="%s"' % endpoint))
+            lines += [
+                '# HELP watchlist_request_sql_queries SQL queries executed per request.',
+                '# TYPE watchlist_request_sql_queries histogram',
+            ]
+            for endpoint, stats in endpoints:
+                lines.extend(stats.queries.lines('watchlist_request_sql_queries', 'endpoint="%s"' % endpoint))
+            for name, attr, help_text in (
+                ('watchlist_sql_queries_total', 'sql_queries', 'SQL queries executed.'),
+                ('watchlist_sql_seconds_total', 'sql_seconds', 'Time spent executing SQL.'),
+                ('watchlist_template_render_seconds_total', 'template_seconds', 'Time spent rendering templates.'),
+            ):
+                lines += ['# HELP %s %s' % (name, help_text), '# TYPE %s counter' % name]
+                for endpoint, stats in endpoints:
+                    lines.append('%s{endpoint="%s"} %s' % (name, endpoint, getattr(stats, attr)))
+        #进程启动时的耗时（见 Watchlist/warmup.py）
+        if startup and startup['startup_seconds'] is not None:
+            for name, key, help_text in (
+                ('watchlist_startup_seconds', 'startup_seconds', 'Time spent in create_app(), including warmup.'),
+                ('watchlist_startup_template_seconds', 'template_seconds', 'Time spent loading templates at startup.'),
+                ('watchlist_startup_mapper_seconds', 'mapper_seconds', 'Time spent configuring ORM mappers at startup.'),
+            ):
+                lines += ['# HELP %s %s' % (name, help_text), '# TYPE %s gauge' % name, '%s %s' % (name, startup[key])]
+            lines += ['# HELP watchlist_template_bytecode_cache Whether the precompiled template cache is in use.',
+                      '# TYPE watchlist_template_bytecode_cache gauge',
+                      'watchlist_template_bytecode_cache %d' % startup['bytecode_cache']]
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -0,0 +1,248 @@
+#数据库结构迁移，由 flask migrate 和 flask initdb 调用
+#
+#每个迁移都根据数据库的实际结构判断是否已经完成，因此 create_all() 新建的数据库会被直接记为已迁移，
+#旧数据库则执行转换；完成的迁移记录在 schema_migration 表中。
+#
+#movie_year_integer：把 movie.year 从 VARCHAR(4) 转换为带 CHECK 约束的 INTEGER。SQLite 不能修改列的类型，
+#做法是新建 movie_new 表，在旧表上建立触发器把新的修改同步过去，再按 id 分批复制已有数据，
+#每批一个短事务，复制期间程序仍可正常读写；最后在一个事务中删除旧表、重命名新表并重建索引和触发器。
+#movie_owner：多用户支持，为 movie 添加 user_id 列，已有的电影分批分配给主用户（id 最小的用户），
+#建立以 user_id 开头的复合索引，并为 user.username 建立唯一索引。
+#movie_title_year_unique：可选的 (user_id, title, year) 唯一索引，同一用户不能重复添加同一部电影，
+#通过 migrate --unique 或 MOVIE_UNIQUE_TITLE_YEAR 配置启用。
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import MetaData
+from sqlalchemy.schema import CreateTable
+
+from Watchlist import db
+from sqlalchemy.exc import IntegrityError
+
+from Watchlist.models import MAX_YEAR, MIN_YEAR, Movie, User
+from Watchlist.search import FTS_DDL
+
+schema_migration = db.Table(
+    'schema_migration',
+    db.Column('name', db.String(100), primary_key=True),
+    db.Column('applied_at', db.DateTime, nullable=False),
+)
+
+UNIQUE_INDEX = 'ux_movie_user_title_year'
+OLD_INDEXES = ('ix_movie_year_id', 'ux_movie_title_year')  # 单用户时代的索引，被以 user_id 开头的索引取代
+
+#旧表中可以转换的行：与 Movie 的 CHECK 约束相同的条件，year 还是字符串
+VALID_ROW = ("length(trim({row}title)) BETWEEN 1 AND 60 "
+             "AND trim({row}year) GLOB '[0-9][0-9][0-9][0-9]' "
+             "AND CAST(trim({row}year) AS INTEGER) BETWEEN %d AND %d" % (MIN_YEAR, MAX_YEAR))
+COPY_COLUMNS = '{row}id, {row}title, CAST(trim({row}year) AS INTEGER)'
+
+MIRROR_TRIGGERS = (
+    "CREATE TRIGGER movie_migrate_insert AFTER INSERT ON movie BEGIN "
+    "INSERT OR REPLACE INTO movie_new (id, title, year) SELECT %s WHERE %s; END"
+    % (COPY_COLUMNS.format(row='new.'), VALID_ROW.format(row='new.')),
+    "CREATE TRIGGER movie_migrate_update AFTER UPDATE ON movie BEGIN "
+    "DELETE FROM movie_new WHERE id = old.id; "
+    "INSERT OR REPLACE INTO movie_new (id, title, year) SELECT %s WHERE %s; END"
+    % (COPY_COLUMNS.format(row='new.'), VALID_ROW.format(row='new.')),
+    "CREATE TRIGGER movie_migrate_delete AFTER DELETE ON movie BEGIN "
+    "DELETE FROM movie_new WHERE id = old.id; END",
+)
+MIRROR_TRIGGER_NAMES = ('movie_migrate_insert', 'movie_migrate_update', 'movie_migrate_delete')
+
+
+class MigrationError(Exception):
+    """迁移无法进行，例如旧数据不满足新的约束。"""
+
+
+@contextmanager
+def _transaction():
+    #pysqlite 不会在 DDL 语句之前自动开始事务，这里手动 BEGIN IMMEDIATE，保证建表、换表等操作是原子的
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.exec_driver_sql('ROLLBACK')
+            raise
+        connection.exec_driver_sql('COMMIT')
+
+
+def _table_sql(connection, name):
+    return connection.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).scalar()
+
+
+def _index_exists(connection, name):
+    return connection.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,)).first() is not None
+
+
+def _columns(connection, table):
+    return {row[1] for row in connection.exec_driver_sql('PRAGMA table_info(%s)' % table)}
+
+
+def _bump_version(connection):
+    #数据的归属或类型变了，让各个 worker 缓存的页面失效
+    connection.exec_driver_sql('UPDATE watchlist_version SET version = version + 1, updated_at = ?',
+                               (datetime.utcnow(),))
+
+
+def year_is_integer(connection=None):
+    """movie 表是否已经是带 CHECK 约束的新结构，是则批量导入可以依赖数据库校验。"""
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    if connection is None:
+        with db.engine.connect() as connection:
+            return year_is_integer(connection)
+    sql = _table_sql(connection, 'movie')
+    return sql is not None and 'ck_movie_year' in sql
+
+
+def migrate_year_integer(batch_size=1000, pause=0.0, drop_invalid=False, echo=print):
+    with db.engine.connect() as connection:
+        invalid = connection.exec_driver_sql('SELECT count(*) FROM movie WHERE NOT (%s)' % VALID_ROW.format(row='')).scalar()
+    if invalid and not drop_invalid:
+        raise MigrationError('%d movies have an empty or too long title or a year outside %d-%d. '
+                             'Fix them or rerun with --drop-invalid.' % (invalid, MIN_YEAR, MAX_YEAR))
+
+    #上次中断留下的临时表和触发器先清理掉，迁移可以重新开始
+    metadata = MetaData()
+    User.__table__.to_metadata(metadata)  # movie.user_id 的外键需要能找到 user 表
+    new_table = Movie.__table__.to_metadata(metadata, name='movie_new')
+    with _transaction() as connection:
+        for name in MIRROR_TRIGGER_NAMES:
+            connection.exec_driver_sql('DROP TRIGGER IF EXISTS %s' % name)
+        connection.exec_driver_sql('DROP TABLE IF EXISTS movie_new')
+        connection.execute(CreateTable(new_table))  # 只建表，索引在换表后再建，避免与旧表的索引重名
+        for statement in MIRROR_TRIGGERS:
+            connection.exec_driver_sql(statement)
+
+    copied, last_id = 0, 0
+    while True:
+        with _transaction() as connection:
+            high = connection.exec_driver_sql(
+                'SELECT max(id) FROM (SELECT id FROM movie WHERE id > ? ORDER BY id LIMIT ?)',
+                (last_id, batch_size)).scalar()
+            if high is None:
+                break
+            copied += connection.exec_driver_sql(
+                'INSERT OR REPLACE INTO movie_new (id, title, year) SELECT %s FROM movie '
+                'WHERE id > ? AND id <= ? AND %s' % (COPY_COLUMNS.format(row=''), VALID_ROW.format(row='')),
+                (last_id, high)).rowcount
+        last_id = high
+        echo('  copied %d movies (up to id %d)' % (copied, last_id))
+        if pause:
+            time.sleep(pause)  # 让出写锁，程序的写入可以穿插进来
+
+    with _transaction() as connection:
+        for name in MIRROR_TRIGGER_NAMES:
+            connection.exec_driver_sql('DROP TRIGGER %s' % name)
+        connection.exec_driver_sql('DROP TABLE movie')  # 旧表上的索引和全文索引触发器一起被删除
+        connection.exec_driver_sql('ALTER TABLE movie_new RENAME TO movie')
+        for index in Movie.__table__.indexes:
+            index.create(connection)
+        fts_exists = _table_sql(connection, 'movie_fts') is not None
+        for statement in FTS_DDL:
+            connection.exec_driver_sql(statement)
+        if invalid or not fts_exists:
+            #丢弃了部分行时全文索引中还留着它们的条目，需要重建
+            connection.exec_driver_sql("INSERT INTO movie_fts(movie_fts) VALUES ('rebuild')")
+        _bump_version(connection)
+    if invalid:
+        echo('  dropped %d invalid movies' % invalid)
+
+
+def owner_is_set(connection):
+    if 'user_id' not in _columns(connection, 'movie') or not _index_exists(connection, 'ix_movie_user_id'):
+        return False
+    #借助 ix_movie_user_id 索引，只检查 user_id 为空的记录
+    return connection.exec_driver_sql('SELECT 1 FROM movie WHERE user_id IS NULL LIMIT 1').first() is None
+
+
+def assign_owner(batch_size=1000, pause=0.0, drop_invalid=False, echo=print):
+    with _transaction() as connection:
+        if 'user_id' not in _columns(connection, 'movie'):
+            #SQLite 添加可为空的列只修改表结构，不会重写已有的行
+            connection.exec_driver_sql('ALTER TABLE movie ADD COLUMN user_id INTEGER REFERENCES user (id)')
+        #先建索引，下面查找 user_id 为空的记录时可以使用
+        for index in Movie.__table__.indexes:
+            index.create(connection, checkfirst=True)
+        owner = connection.exec_driver_sql('SELECT min(id) FROM user').scalar()
+
+    assigned = 0
+    while True:
+        with _transaction() as connection:
+            count = connection.exec_driver_sql(
+                'UPDATE movie SET user_id = ? WHERE id IN (SELECT id FROM movie WHERE user_id IS NULL LIMIT ?)',
+                (owner, batch_size)).rowcount if owner is not None else 0
+            if not count:
+                orphans = connection.exec_driver_sql('SELECT count(*) FROM movie WHERE user_id IS NULL').scalar()
+                if orphans:
+                    raise MigrationError('%d movies have no owner and there are no users yet, '
+                                         'create one with flask admin and rerun flask migrate.' % orphans)
+                break
+        assigned += count
+        echo('  assigned %d movies to user %d' % (assigned, owner))
+        if pause:
+            time.sleep(pause)
+
+    with _transaction() as connection:
+        for name in OLD_INDEXES:
+            connection.exec_driver_sql('DROP INDEX IF EXISTS %s' % name)
+        try:
+            for index in User.__table__.indexes:
+                index.create(connection, checkfirst=True)
+        except IntegrityError:
+            raise MigrationError('Some usernames are used by more than one user, rename them first.')
+        _bump_version(connection)
+
+
+def create_unique_index(batch_size=1000, pause=0.0, drop_invalid=False, echo=print):
+    with _transaction() as connection:
+        duplicates = connection.exec_driver_sql(
+            'SELECT count(*) FROM (SELECT 1 FROM movie GROUP BY user_id, title, year HAVING count(*) > 1)').scalar()
+        if duplicates:
+            raise MigrationError('%d (title, year) pairs appear more than once in the same watchlist, '
+                                 'remove the duplicates first.' % duplicates)
+        connection.exec_driver_sql('CREATE UNIQUE INDEX %s ON movie (user_id, title, year)' % UNIQUE_INDEX)
+
+
+# (名称, 说明, 是否已完成, 执行函数, 是否可选)，按顺序执行
+MIGRATIONS = (
+    ('movie_year_integer', 'Store movie.year as an INTEGER with CHECK constraints',
+     year_is_integer, migrate_year_integer, False),
+    ('movie_owner', 'Add movie.user_id and per-user indexes, assign existing movies to the admin user',
+     owner_is_set, assign_owner, False),
+    ('movie_title_year_unique', 'Unique index on movie (user_id, title, year)',
+     lambda connection: _index_exists(connection, UNIQUE_INDEX), create_unique_index, True),
+)
+
+
+def status():
+    """返回 [(名称, 说明, 是否已完成, 是否可选)]。"""
+    with db.engine.connect() as connection:
+        return [(name, description, done(connection), optional)
+                for name, description, done, migrate, optional in MIGRATIONS]
+
+
+def upgrade(unique=False, batch_size=1000, pause=0.0, drop_invalid=False, echo=print):
+    """执行所有未完成的迁移（可选迁移只在 unique 为 True 时执行），返回本次执行的迁移名称。"""
+    if db.engine.dialect.name != 'sqlite':
+        raise MigrationError('Migrations are only implemented for SQLite.')
+    db.create_all()  # 补建新增的表（包括 schema_migration），已存在的表不受影响
+    applied = []
+    for name, description, done, migrate, optional in MIGRATIONS:
+        if optional and not unique:
+            continue
+        with db.engine.connect() as connection:
+            finished = done(connection)
+        if not finished:
+            echo('Applying %s: %s' % (name, description))
+            migrate(batch_size=batch_size, pause=pause, drop_invalid=drop_invalid, echo=echo)
+            applied.append(name)
+        with db.engine.begin() as connection:
+            if connection.execute(db.select(schema_migration.c.name).where(schema_migration.c.name == name)).first() is None:
+                connection.execute(schema_migration.insert().values(name=name, applied_at=datetime.utcnow()))
+    return applied
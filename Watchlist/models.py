@@ -1,22 +1,190 @@
 #数据库模型
-from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
-from Watchlist import db # 注意这里可能会导致循环依赖？
+import re
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import chain
+
+from flask_login import UserMixin, current_user
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+from Watchlist import db, cache # 注意这里可能会导致循环依赖？
+from Watchlist.replica import cache_key
+from Watchlist.security import hasher
 
 #通过db创建数据库模型（每个单独的模型对应一张数据库表）
 class User(db.Model, UserMixin): # 表名为user，继承UserMixin会让 User 类拥有几个用于判断认证状态的属性和方法
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(20))
-    username = db.Column(db.String(20))
+    username = db.Column(db.String(20), unique=True, index=True)  # 登录时按用户名查找
     password_hash = db.Column(db.String(128)) #密码散列值
 
     def set_password(self, password): #接收用户输入的密码，将其转换为散列值
         #类属性在实例方法中也可使用self来引用
-        self.password_hash = generate_password_hash(password)
+        #散列在有界线程池中计算，线程池繁忙时抛出 HashingBusy
+        self.password_hash = hasher.generate(password)
     def validate_password(self, password): #验证用户的密码是否与数据库中的散列值
-        return check_password_hash(self.password_hash, password)
+        return hasher.check(self.password_hash, password)
+
+    # 以下两个方法返回缓存的用户记录，供模板上下文处理函数和用户加载回调使用
+    # 缓存的对象是脱离会话（detached）的副本，只能读取；需要修改用户时应重新查询
+    @classmethod
+    def get_cached(cls, user_id):
+        return cache.get_or_set(cache_key('user:%d' % user_id), lambda: cls._detached_copy(cls.query.get(user_id)))
+
+    @classmethod
+    def first_cached(cls):
+        #第一个用户（id 最小）是主用户，未登录的访客看到的是他的片单
+        return cache.get_or_set(cache_key('user:first'), lambda: cls._detached_copy(cls.query.order_by(cls.id).first()))
+
+    @classmethod
+    def _detached_copy(cls, user):
+        if user is None:
+            return None
+        # 复制各列的值而不是直接缓存查询结果，避免把当前会话中仍在使用的对象移出会话
+        copy = cls(**{column.key: getattr(user, column.key) for column in cls.__table__.columns})
+        make_transient_to_detached(copy)
+        return copy
     
+# 年份的取值范围，表单校验和数据库中的 CHECK 约束共用
+MIN_YEAR, MAX_YEAR = 1000, 9999
+
+
 class Movie(db.Model):
+    # 所有查询都限定在某个用户的片单内，两个复合索引都以 user_id 开头：
+    # (user_id, id) 用于默认的键集分页和计数，(user_id, year, id) 用于按年份排序和年份过滤，
+    # 这样每页的查询只读取该用户的索引范围，与用户数和电影总数无关
+    # CHECK 约束让数据库本身拒绝不合法的数据（旧数据库需要先运行 flask migrate）；INTEGER 列仍会接受 2019.5 这样的小数，
+    # 因此还要检查 typeof(year)，而 '1e3' 这样的文本会被转换成整数 1000，批量导入仍需先用 movie_is_valid 校验
+    # (user_id, title, year) 的唯一索引是可选的，见 Watchlist/migrations.py
+    __table_args__ = (
+        db.Index('ix_movie_user_id', 'user_id', 'id'),
+        db.Index('ix_movie_user_year_id', 'user_id', 'year', 'id'),
+        db.CheckConstraint("typeof(year) = 'integer' AND year BETWEEN %d AND %d" % (MIN_YEAR, MAX_YEAR),
+                          name='ck_movie_year'),
+        db.CheckConstraint('length(trim(title)) BETWEEN 1 AND 60', name='ck_movie_title'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    title = db.Column(db.String(60))
-    year = db.Column(db.String(4))
\ No newline at end of file
+    title = db.Column(db.String(60), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    # 旧数据库通过 ALTER TABLE 添加这一列，因此数据库中允许为空；flask migrate 会把旧记录分配给主用户
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+
+    @classmethod
+    def count(cls, user_id):
+        #每个用户的电影数会被缓存，避免每次渲染主页都执行 COUNT(*)
+        return cache.get_or_set(cache_key('movie_count:%d' % user_id),
+                                lambda: db.session.query(db.func.count(cls.id)).filter(cls.user_id == user_id).scalar())
+
+
+class WatchlistVersion(db.Model):
+    # 只有一行记录，每次提交修改了电影或用户的事务都会让版本号加一
+    # 片段缓存的键和 ETag 都由它生成，因此多个 worker 之间也能感知到数据的变化
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @classmethod
+    def current(cls):
+        #返回 (版本号, 更新时间)，结果会被短暂缓存；表为空时返回 (0, None)
+        def load():
+            row = db.session.query(cls.version, cls.updated_at).filter_by(id=1).first()
+            return tuple(row) if row is not None else (0, None)
+        return cache.get_or_set(cache_key('watchlist_version'), load)
+
+    @classmethod
+    def bump(cls, session):
+        #直接在当前事务的连接上执行原子的 UPDATE，与数据修改一起提交
+        table = cls.__table__
+        now = datetime.utcnow()
+        connection = session.connection()
+        result = connection.execute(table.update().where(table.c.id == 1)
+                                    .values(version=table.c.version + 1, updated_at=now))
+        if result.rowcount == 0:
+            connection.execute(table.insert().values(id=1, version=1, updated_at=now))
+
+
+class ServerSessionRecord(db.Model):
+    # 服务器端会话（SESSION_BACKEND=server）的存储表，由 Watchlist.sessions 直接用 Core 语句读写
+    __tablename__ = 'server_session'
+
+    sid = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+def current_owner():
+    """当前请求显示谁的片单：已登录的用户看自己的，未登录的访客看主用户的；没有任何用户时返回 None。"""
+    if current_user.is_authenticated:
+        return current_user
+    return User.first_cached()
+
+
+def current_owner_id():
+    owner = current_owner()
+    return owner.id if owner is not None else 0  # 0 不对应任何用户，查询结果为空
+
+
+#电影数据的校验规则，与 Movie 表的 CHECK 约束一致；表单和 API 先在这里校验，以便给出友好的提示
+#年份只接受 ASCII 数字（与迁移中的 GLOB '[0-9][0-9][0-9][0-9]' 相同），str.isdigit() 会放过 '²⁰⁰⁰' 这类 int() 无法转换的字符
+YEAR_PATTERN = re.compile(r'[0-9]{4}')
+
+
+def movie_is_valid(title, year):
+    year = str(year)
+    return bool(title) and bool(title.strip()) and len(title) <= 60 \
+        and YEAR_PATTERN.fullmatch(year) is not None and MIN_YEAR <= int(year) <= MAX_YEAR
+
+
+def mark_changed(session, *models):
+    """记录本次事务修改了哪些模型。
+
+    ORM 对象的修改会在 flush 时自动记录；绕过 ORM 单元的批量语句（如 insert() 的 executemany）
+    需要手动调用，以便提交后缓存能够失效。
+    """
+    session.info.setdefault('changed_models', set()).update(models)
+    if {Movie, User} & set(models) and not session.info.get('version_bumped'):
+        WatchlistVersion.bump(session)
+        session.info['version_bumped'] = True
+
+
+#在会话提交前记录本次事务修改了哪些模型，提交成功后再让相关缓存失效
+@event.listens_for(db.session, 'before_flush')
+def track_changes(session, flush_context, instances):
+    mark_changed(session, *{type(obj) for obj in chain(session.new, session.dirty, session.deleted)})
+
+#SAVEPOINT（begin_nested()）的释放和回滚也会触发以下两个事件，只在最外层事务结束时处理
+@event.listens_for(db.session, 'after_commit')
+def invalidate_cache(session):
+    if session.in_nested_transaction():
+        return
+    changed = session.info.pop('changed_models', set())
+    if session.info.pop('version_bumped', False):
+        cache.delete('watchlist_version')
+        cache.delete_prefix('movie_list:')
+        cache.delete_prefix('compressed:')  # 按 ETag 缓存的压缩结果，旧版本的 ETag 不会再被使用
+    if Movie in changed:
+        cache.delete_prefix('movie_count:')
+    if User in changed:
+        cache.delete_prefix('user:')
+
+@event.listens_for(db.session, 'after_rollback')
+def reset_changes(session):
+    if session.in_nested_transaction():
+        return
+    session.info.pop('changed_models', None)
+    session.info.pop('version_bumped', None)
+
+
+@contextmanager
+def savepoint(session):
+    """在 SAVEPOINT 中执行一组修改，离开时 flush，出错时只回滚这一组，异常照常抛出。"""
+    bumped = session.info.get('version_bumped')
+    try:
+        with session.begin_nested():
+            yield
+    except BaseException:
+        #版本号在这个 SAVEPOINT 中更新时已随之回滚，清除标记，后面的修改需要重新更新
+        if not bumped:
+            session.info.pop('version_bumped', None)
+        raise
\ No newline at end of file
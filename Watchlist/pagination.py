@@ -0,0 +1,112 @@
+#基于键集（keyset / seek）的分页
+#与 OFFSET 分页不同，这里用上一页最后一行的排序键作为游标，配合索引直接定位，翻到多深的页面耗时都一样
+from Watchlist import db
+from Watchlist.models import Movie
+
+# 支持的排序方式：名称 -> 排序键所包含的列
+# 查询都带有 user_id = ? 条件，排序键与它组合后分别对应 ix_movie_user_id 和 ix_movie_user_year_id 索引
+SORTS = {
+    'id': (Movie.id,),
+    'year': (Movie.year, Movie.id),
+}
+
+
+class KeysetPage:
+    def __init__(self, items, sort, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.sort = sort
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def encode_cursor(movie, sort):
+    if sort == 'year':
+        return '%s.%d' % (movie.year, movie.id)
+    return str(movie.id)
+
+
+def decode_cursor(cursor, sort):
+    """把游标字符串解析为排序键元组，非法游标返回 None（即从第一页开始）。"""
+    if not cursor:
+        return None
+    try:
+        if sort == 'year':
+            year, movie_id = cursor.rsplit('.', 1)
+            return int(year), int(movie_id)
+        return (int(cursor),)
+    except ValueError:
+        return None
+
+
+def _after(columns, key):
+    #构造 (a, b) > (x, y) 的条件，展开成 a > x OR (a = x AND b > y) 的形式以便使用索引
+    first, rest = columns[0], columns[1:]
+    if not rest:
+        return first > key[0]
+    return db.or_(first > key[0], db.and_(first == key[0], _after(rest, key[1:])))
+
+
+def _before(columns, key):
+    first, rest = columns[0], columns[1:]
+    if not rest:
+        return first < key[0]
+    return db.or_(first < key[0], db.and_(first == key[0], _before(rest, key[1:])))
+
+
+def keyset_query(query, sort='id', after=None, before=None, per_page=50):
+    """给查询加上分页所需的条件、排序和行数限制，返回 (查询, 把查询结果转换成 KeysetPage 的函数)。
+
+    query 可以是 Movie.query，也可以是 select(Movie)，后者供异步模式（Watchlist/aio.py）使用；
+    通常已经带有 user_id 条件，只分页某个用户的电影。
+    """
+    if sort not in SORTS:
+        sort = 'id'
+    columns = SORTS[sort]
+
+    after_key = decode_cursor(after, sort)
+    before_key = decode_cursor(before, sort) if after_key is None else None
+
+    if before_key is not None:
+        #向前翻页：倒序取 per_page + 1 行，多出来的一行说明前面还有数据
+        def finish(rows):
+            has_more = len(rows) > per_page
+            items = list(reversed(rows[:per_page]))
+            prev_cursor = encode_cursor(items[0], sort) if has_more else None
+            next_cursor = encode_cursor(items[-1], sort) if items else None
+            return KeysetPage(items, sort, next_cursor=next_cursor, prev_cursor=prev_cursor)
+        query = query.filter(_before(columns, before_key)).order_by(*[c.desc() for c in columns])
+    else:
+        def finish(rows):
+            has_more = len(rows) > per_page
+            items = rows[:per_page]
+            next_cursor = encode_cursor(items[-1], sort) if has_more else None
+            prev_cursor = encode_cursor(items[0], sort) if after_key is not None and items else None
+            return KeysetPage(items, sort, next_cursor=next_cursor, prev_cursor=prev_cursor)
+        if after_key is not None:
+            query = query.filter(_after(columns, after_key))
+        query = query.order_by(*columns)
+    return query.limit(per_page + 1), finish
+
+
+def paginate_movies(user_id, sort='id', after=None, before=None, per_page=50):
+    """返回某个用户的一页电影记录，after/before 为游标字符串，两者同时给出时以 after 为准。"""
+    query, finish = keyset_query(Movie.query.filter_by(user_id=user_id), sort, after, before, per_page)
+    return finish(query.all())
+
+
+def iter_movies(user_id, sort='id', batch_size=1000):
+    """按排序方式遍历某个用户的全部电影，每次只从数据库游标中取出 batch_size 行。
+
+    只查询需要的列，结果是轻量的行对象而不是 ORM 实例，模板中同样可以用 movie.title 访问。
+    """
+    columns = SORTS.get(sort, SORTS['id'])
+    return db.session.query(Movie.id, Movie.title, Movie.year).filter(Movie.user_id == user_id) \
+        .order_by(*columns).yield_per(batch_size)
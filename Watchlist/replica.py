@@ -0,0 +1,128 @@
+#读写分离：GET 请求的查询使用只读连接，写入始终使用主数据库
+#
+#READ_REPLICA 配置只读数据来自哪里：
+#  primary   以 mode=ro 打开主数据库文件本身。WAL 模式下读不阻塞写，只读连接也不会意外持有写锁，数据没有延迟。
+#  文件路径   由 flask snapshot 定期生成的快照文件，以 mode=ro&immutable=1 打开，SQLite 不再检查文件是否变化、不加任何锁。
+#            snapshot 写完临时文件后整体替换，已打开的连接继续读取旧文件，连接池按 READ_REPLICA_RECYCLE 回收连接后读到新快照。
+#使用快照时数据有延迟：用户提交修改后的 READ_REPLICA_STICKY 秒内，他的请求仍然读主数据库，保证能看到自己刚写入的数据。
+#快照和主数据库的查询结果不能共用进程内缓存的条目，读快照时缓存键由 cache_key() 加上 replica: 前缀。
+#
+#路由在 RoutingSession.get_bind() 中完成，视图代码不需要改动；flush（即写入）和非 GET 请求总是使用主数据库。
+import os
+import sqlite3
+import time
+
+from flask import current_app, has_request_context, request, session as http_session
+from flask.globals import request_ctx
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+
+from Watchlist.database import apply_sqlite_pragmas
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class RoutingSession(Session):
+    """db.session 使用的会话类：只读请求的查询交给只读引擎。"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and _use_replica():
+            return current_app.extensions['watchlist_replica']['engine']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _use_replica():
+    if not has_request_context() or request.method not in READ_METHODS:
+        return False
+    #服务器端会话在打开时就会查询（读取数据版本号），此时还不能读取会话，这些查询使用主数据库
+    if request_ctx.session is None:
+        return False
+    state = current_app.extensions.get('watchlist_replica')
+    if state is None:
+        return False
+    return http_session.get('_primary_until', 0) < time.time()
+
+
+def cache_key(key):
+    """返回查询结果的缓存键：当前请求读有延迟的快照时加上前缀，与读主数据库时缓存的结果分开。
+
+    快照中的条目不会因主数据库的提交而失效，只随 CACHE_TTL 过期，快照本身也只会定期刷新。
+    """
+    if _use_replica() and current_app.extensions['watchlist_replica']['lagging']:
+        return 'replica:' + key
+    return key
+
+
+def replica_uri(primary_uri, replica):
+    """根据 READ_REPLICA 配置返回只读数据库的地址。"""
+    url = make_url(primary_uri)
+    if replica == 'primary':
+        path, query = url.database, {'mode': 'ro', 'uri': 'true'}
+    else:
+        path, query = os.path.abspath(replica), {'mode': 'ro', 'immutable': '1', 'uri': 'true'}
+    return url.set(database='file:' + path, query=query)
+
+
+def snapshot(engine, dest, pages=-1, pause=0.0, progress=None):
+    """用 SQLite 的在线备份 API 把 engine 对应的数据库复制到 dest，写完后原子地替换 dest。
+
+    pages 为 -1 时在一个读事务中复制全部页面，得到一致的快照，WAL 模式下不阻塞写入；
+    pages 为正数时分步复制，每步之间让出锁，期间源数据库被修改时 SQLite 会自动从头重新复制。
+    """
+    tmp = '%s.tmp-%d' % (dest, os.getpid())
+    target = sqlite3.connect(tmp)
+    source = engine.raw_connection()
+    try:
+        source.driver_connection.backup(target, pages=pages, sleep=pause, progress=progress)
+        #快照以 immutable 方式打开，不能依赖 -wal、-shm 文件
+        target.execute('PRAGMA journal_mode = DELETE')
+        target.close()
+        os.replace(tmp, dest)
+    except BaseException:
+        target.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    finally:
+        source.close()
+
+
+class ReadReplica:
+    """Flask 扩展：根据 READ_REPLICA 配置创建只读引擎。"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('READ_REPLICA_RECYCLE', 60)  # 秒，快照的连接使用多久后重新打开
+        app.config.setdefault('READ_REPLICA_STICKY', 300)  # 秒，应不短于快照的刷新间隔加上 READ_REPLICA_RECYCLE
+        replica = app.config['READ_REPLICA']
+        if not replica or make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name() != 'sqlite':
+            app.extensions.pop('watchlist_replica', None)
+            return
+        options = dict(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+        if replica != 'primary':
+            options['pool_recycle'] = app.config['READ_REPLICA_RECYCLE']
+        engine = create_engine(replica_uri(app.config['SQLALCHEMY_DATABASE_URI'], replica), **options)
+        #只读连接上不能切换日志模式
+        apply_sqlite_pragmas(engine, {name: value for name, value in app.config['SQLITE_PRAGMAS'].items()
+                                      if name != 'journal_mode'})
+        app.extensions['watchlist_replica'] = {'engine': engine, 'lagging': replica != 'primary'}
+        from Watchlist import db
+        if not event.contains(db.session, 'after_flush', self._after_flush):
+            event.listen(db.session, 'after_flush', self._after_flush)
+
+    def _after_flush(self, session, flush_context):
+        self.stick_to_primary()
+
+    @staticmethod
+    def stick_to_primary():
+        """当前请求写入了数据：该用户在快照追上之前读主数据库。在请求上下文之外调用时不做任何事。"""
+        state = current_app.extensions.get('watchlist_replica') if has_request_context() else None
+        if state is not None and state['lagging'] and current_app.config['READ_REPLICA_STICKY']:
+            http_session['_primary_until'] = time.time() + current_app.config['READ_REPLICA_STICKY']
+
+
+replica = ReadReplica()
@@ -0,0 +1,74 @@
+#基于 SQLite FTS5 的电影标题全文搜索
+#movie_fts 是以 movie 表为内容表（external content）的虚拟表，只保存倒排索引，由触发器与 movie 表保持同步
+#触发器在数据库层面生效，因此表单、批量导入等任何写入方式都不会让索引过期
+import re
+
+from sqlalchemy import DDL, event
+
+from Watchlist import db
+from Watchlist.models import Movie
+
+FTS_DDL = (
+    # prefix='2 3' 额外为长度为 2、3 的前缀建立索引，加快短前缀的查询
+    "CREATE VIRTUAL TABLE IF NOT EXISTS movie_fts USING fts5("
+    "title, content='movie', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS movie_fts_insert AFTER INSERT ON movie BEGIN "
+    "INSERT INTO movie_fts(rowid, title) VALUES (new.id, new.title); END",
+    "CREATE TRIGGER IF NOT EXISTS movie_fts_delete AFTER DELETE ON movie BEGIN "
+    "INSERT INTO movie_fts(movie_fts, rowid, title) VALUES ('delete', old.id, old.title); END",
+    "CREATE TRIGGER IF NOT EXISTS movie_fts_update AFTER UPDATE OF title ON movie BEGIN "
+    "INSERT INTO movie_fts(movie_fts, rowid, title) VALUES ('delete', old.id, old.title); "
+    "INSERT INTO movie_fts(rowid, title) VALUES (new.id, new.title); END",
+)
+
+# 虚拟表不放进 db.metadata，否则 create_all() 会把它当作普通表创建
+movie_fts = db.table('movie_fts', db.column('rowid'), db.column('rank'))
+
+#db.create_all() 创建 movie 表后自动创建索引和触发器，drop_all() 时一并删除
+for statement in FTS_DDL:
+    event.listen(Movie.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(Movie.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS movie_fts').execute_if(dialect='sqlite'))
+
+
+def create_index():
+    """为已存在的 movie 表补建全文索引，新建索引时用已有数据重建。返回是否新建了索引。"""
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    with db.engine.begin() as connection:
+        exists = connection.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'movie_fts'").first()
+        for statement in FTS_DDL:
+            connection.exec_driver_sql(statement)
+        if not exists:
+            connection.exec_driver_sql("INSERT INTO movie_fts(movie_fts) VALUES ('rebuild')")
+    return not exists
+
+
+def match_expression(text):
+    #把用户输入拆成词，每个词都加上双引号（避免被解析为 FTS5 语法）并按前缀匹配，词与词之间是 AND 关系
+    terms = re.findall(r'\w+', text or '')
+    return ' '.join('"%s"*' % term for term in terms)
+
+
+def search_movies(text, user_id, year=None, year_from=None, year_to=None, limit=50):
+    """在某个用户的电影中按标题搜索，结果按相关度排序。"""
+    expression = match_expression(text)
+    if not expression:
+        return []
+    if db.engine.dialect.name == 'sqlite':
+        query = Movie.query.join(movie_fts, movie_fts.c.rowid == Movie.id) \
+            .filter(db.literal_column('movie_fts').op('MATCH')(expression)) \
+            .order_by(movie_fts.c.rank)
+    else:
+        #其他数据库没有 FTS5，退化为逐词的前缀匹配
+        query = Movie.query.order_by(Movie.id)
+        for term in re.findall(r'\w+', text):
+            query = query.filter(Movie.title.ilike(term + '%') | Movie.title.ilike('% ' + term + '%'))
+    query = query.filter(Movie.user_id == user_id)
+    if year:
+        query = query.filter(Movie.year == year)
+    if year_from:
+        query = query.filter(Movie.year >= year_from)
+    if year_to:
+        query = query.filter(Movie.year <= year_to)
+    return query.limit(limit).all()
@@ -0,0 +1,109 @@
+#登录相关的性能保护：在有界线程池中计算密码散列，以及登录请求的令牌桶限流
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from flask import current_app, has_app_context
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HashingBusy(Exception):
+    """散列线程池已满，或排队等待超时。"""
+
+
+class PasswordHasher:
+    """在有界线程池中计算密码散列。
+
+    散列计算刻意设计得很慢，放在独立的线程池中并限制并发数量，登录高峰时最多占用 HASH_WORKERS 个 CPU，
+    普通页面请求不会被饿死。hashlib 的 scrypt/pbkdf2 计算期间会释放 GIL，因此线程池即可实现并行。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('HASH_WORKERS', 2)  # 同时计算散列的线程数
+        app.config.setdefault('HASH_MAX_PENDING', 8)  # 允许排队等待的任务数，超出时直接拒绝
+        app.config.setdefault('HASH_QUEUE_TIMEOUT', 5.0)  # 秒，等待结果的最长时间
+        app.extensions['password_hasher'] = {
+            'executor': ThreadPoolExecutor(app.config['HASH_WORKERS'], thread_name_prefix='password-hash'),
+            'slots': threading.BoundedSemaphore(app.config['HASH_WORKERS'] + app.config['HASH_MAX_PENDING']),
+        }
+
+    def _run(self, func, *args):
+        #在程序上下文之外（例如直接在脚本中使用模型）时同步计算
+        if not has_app_context() or 'password_hasher' not in current_app.extensions:
+            return func(*args)
+        state = current_app.extensions['password_hasher']
+        if not state['slots'].acquire(blocking=False):
+            raise HashingBusy()
+        future = state['executor'].submit(func, *args)
+        future.add_done_callback(lambda f: state['slots'].release())
+        try:
+            return future.result(timeout=current_app.config['HASH_QUEUE_TIMEOUT'])
+        except TimeoutError:
+            future.cancel()  # 仍在排队的任务会被取消，已开始的任务会在完成后释放名额
+            raise HashingBusy()
+
+    def check(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def generate(self, password):
+        return self._run(generate_password_hash, password)
+
+
+class TokenBucket:
+    """按键（IP、用户名）分别计数的令牌桶，桶的数量有上限，最久未使用的桶会被淘汰。"""
+
+    def __init__(self, capacity, period, maxsize=10000):
+        self.capacity = capacity
+        self.rate = capacity / period  # 每秒补充的令牌数
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # key -> (令牌数, 上次更新时间)
+        self._lock = threading.Lock()
+
+    def consume(self, key):
+        """尝试取出一个令牌，成功返回 0，否则返回需要等待的秒数。"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - last) * self.rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+            if not wait:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+class LoginLimiter:
+    """在 /login 前按 IP 和用户名限流，防止撞库请求占满所有 worker。"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # (令牌桶容量, 补满所需秒数)，设为 None 表示不限制
+        app.config.setdefault('LOGIN_IP_LIMIT', (20, 60))
+        app.config.setdefault('LOGIN_USERNAME_LIMIT', (5, 60))
+        app.extensions['login_limiter'] = {
+            name: TokenBucket(*app.config[option]) if app.config[option] else None
+            for name, option in (('ip', 'LOGIN_IP_LIMIT'), ('username', 'LOGIN_USERNAME_LIMIT'))
+        }
+
+    def check(self, ip, username):
+        """返回需要等待的秒数，0 表示允许本次登录尝试。"""
+        buckets = current_app.extensions['login_limiter']
+        wait = 0
+        for name, key in (('ip', ip), ('username', username)):
+            if buckets[name] is not None and key:
+                wait = max(wait, buckets[name].consume(key))
+        return wait
+
+
+hasher = PasswordHasher()
+login_limiter = LoginLimiter()
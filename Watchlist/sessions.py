@@ -0,0 +1,167 @@
+#服务器端会话：Cookie 中只保存签名后的会话 ID，会话数据保存在数据库的 server_session 表中
+#表前面有一层进程内的 LRU 缓存，同时缓存已加载的用户对象，已登录的请求通常只需按主键读一次会话表，不用查询用户
+#
+#每个请求都会确认会话记录仍然存在：某个 worker 处理了登出，其他 worker 缓存中的会话也立即失效。
+#读到的数据与缓存中的不同（其他 worker 修改过会话）时丢弃缓存的用户对象，重新加载。
+#只有登录、登出时才换用新的会话 ID 防止会话固定攻击；闪现消息等其他修改原地更新记录，
+#同一会话中并发的请求（例如多个标签页）仍然使用有效的 ID。
+import secrets
+from datetime import datetime
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+from Watchlist import db
+from Watchlist.cache import TTLCache
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, principal=None, principal_version=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.modified = False
+        self._principal = principal
+        self.principal_version = principal_version  # 加载用户对象时的数据版本号
+        self.principal_changed = False
+        self.login_id = self.get('_user_id')  # 打开会话时登录的用户，保存时与之不同表示登录或登出
+
+    @property
+    def principal(self):
+        """已登录用户的只读副本（与 User.get_cached() 相同），由 load_user 读取和设置。"""
+        return self._principal
+
+    @principal.setter
+    def principal(self, user):
+        from Watchlist.models import WatchlistVersion
+        #记录加载时的版本号而不是保存时的：设置页面在同一个请求中修改并提交了用户，保存时的版本号已经是新的
+        self._principal = user
+        self.principal_version = WatchlistVersion.current() if user is not None else None
+        self.principal_changed = True
+
+
+class ServerSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()  # 与 Flask 默认的 Cookie 会话相同，支持闪现消息中的元组等类型
+    salt = 'watchlist-session'
+
+    def __init__(self, app):
+        self.cache = TTLCache(app.config['SESSION_CACHE_MAXSIZE'])
+        self.cache_ttl = app.config['SESSION_CACHE_TTL']
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt=self.salt)
+
+    def open_session(self, app, request):
+        from Watchlist.models import ServerSessionRecord, WatchlistVersion
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if not cookie:
+            return ServerSession()
+        try:
+            sid = self._signer(app).unsign(cookie).decode()
+        except BadSignature:  # 伪造的 ID 不会查询数据库
+            return ServerSession()
+
+        table = ServerSessionRecord.__table__
+        with db.engine.connect() as conn:
+            row = conn.execute(db.select(table.c.data).where(
+                table.c.sid == sid, table.c.expires_at > datetime.utcnow())).first()
+        if row is None:  # 已登出、过期或被其他 worker 删除
+            self.cache.delete(sid)
+            return ServerSession()
+        entry = self.cache.get(sid)
+        if entry is None or entry[0] != row.data:
+            entry = (row.data, None, None)
+            self.cache.set(sid, entry, self.cache_ttl)
+
+        data, principal, version = entry
+        #用户或电影修改后版本号会改变，缓存的用户对象随之作废
+        if principal is not None and version != WatchlistVersion.current():
+            principal = None
+        return ServerSession(self.serializer.loads(data), sid=sid, principal=principal,
+                             principal_version=version if principal is not None else None)
+
+    def save_session(self, app, session, response):
+        from Watchlist.models import ServerSessionRecord
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        table = ServerSessionRecord.__table__
+
+        #用户对象只属于登录了该用户的会话，登出后 _user_id 被移除，缓存的用户对象也一起丢弃
+        principal, version = session.principal, session.principal_version
+        if principal is not None and session.get('_user_id') != str(principal.id):
+            principal, version = None, None
+
+        if not session.modified:
+            if session.sid and session.principal_changed:
+                #会话数据没有变化，只是新加载了用户对象，更新内存中的条目即可，不需要写数据库
+                self.cache.set(session.sid, (self.serializer.dumps(dict(session)), principal, version),
+                               self.cache_ttl)
+            return
+
+        if not session:
+            if session.sid:
+                self.cache.delete(session.sid)
+                with db.engine.begin() as conn:
+                    conn.execute(table.delete().where(table.c.sid == session.sid))
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        data = self.serializer.dumps(dict(session))
+        now = datetime.utcnow()
+        expires_at = now + app.permanent_session_lifetime
+        if session.sid and session.get('_user_id') == session.login_id:
+            #登录状态没有变化，原地更新；记录已被删除（其他请求登出了该会话）时不再恢复它
+            sid = session.sid
+            with db.engine.begin() as conn:
+                updated = conn.execute(table.update().where(table.c.sid == sid).values(
+                    data=data, expires_at=expires_at)).rowcount
+            if not updated:
+                self.cache.delete(sid)
+                response.delete_cookie(name, domain=domain, path=path)
+                return
+        else:
+            sid = secrets.token_urlsafe(32)
+            with db.engine.begin() as conn:
+                if session.sid:
+                    conn.execute(table.delete().where(table.c.sid == session.sid))
+                else:
+                    #新会话创建时顺便清理已过期的记录，expires_at 上有索引
+                    conn.execute(table.delete().where(table.c.expires_at <= now))
+                conn.execute(table.insert().values(sid=sid, data=data, expires_at=expires_at))
+            if session.sid:
+                self.cache.delete(session.sid)
+        self.cache.set(sid, (data, principal, version), self.cache_ttl)
+
+        response.set_cookie(
+            name,
+            self._signer(app).sign(sid).decode(),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+        response.vary.add('Cookie')
+
+
+class ServerSessions:
+    """Flask 扩展：SESSION_BACKEND 为 server 时用服务器端会话替换默认的 Cookie 会话。"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SESSION_BACKEND', 'cookie')
+        app.config.setdefault('SESSION_CACHE_MAXSIZE', 10000)
+        app.config.setdefault('SESSION_CACHE_TTL', 300)  # 秒，缓存的会话数据和用户对象保留多久（每个请求仍会确认记录存在）
+        if app.config['SESSION_BACKEND'] == 'server':
+            app.session_interface = ServerSessionInterface(app)
+
+
+server_sessions = ServerSessions()
@@ -1,71 +1,207 @@
+import hashlib
+import math
 
-from flask import request, redirect, render_template, url_for, flash
+from flask import Blueprint, abort, current_app, request, redirect, render_template, url_for, flash, session, make_response, jsonify, \
+    get_flashed_messages, stream_template
 from flask_login import current_user, login_user, login_required, logout_user
-from Watchlist import app, db #注意这里可能会导致循环依赖？
-from Watchlist.models import User, Movie
+from markupsafe import Markup
+from sqlalchemy.exc import IntegrityError
+from werkzeug.http import is_resource_modified
+from Watchlist import db, cache
+from Watchlist.models import User, Movie, WatchlistVersion, current_owner_id, movie_is_valid
+from Watchlist.pagination import iter_movies, paginate_movies
+from Watchlist.replica import cache_key
+from Watchlist.search import search_movies
+from Watchlist.security import HashingBusy, login_limiter
+from Watchlist.writes import WriteTimeout, writes
+
+main = Blueprint('main', __name__)
+
+#执行并提交写操作（开启 WRITE_COALESCING 时与其他请求的写操作合并提交，见 Watchlist/writes.py）
+#违反数据库约束或排队超时时提示，返回是否成功
+def _write(operation):
+    try:
+        writes.submit(operation)
+    except IntegrityError as e:
+        flash('This movie is already in the list.' if 'UNIQUE' in str(e.orig) else 'Invalid input.')
+        return False
+    except WriteTimeout:
+        flash('Server busy, please try again.')
+        return False
+    return True
 
 #主页
 #默认情况下，页面只能处理get请求，可以使用methods关键字修改
-@app.route('/', methods=['GET', 'POST'])
+@main.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == "POST":
         if not current_user.is_authenticated: #对于未登录的用户，其is_authenticated属性为False
-            return redirect(url_for('index'))  # 重定向到主页
+            return redirect(url_for('.index'))  # 重定向到主页
         #获取表单数据
         title = request.form.get('title').strip()#传入参数是表单对应字段的name
         year = request.form.get('year').strip()
         #验证数据
-        if not title or not year or len(year) != 4 or len(title) > 60:
+        if not movie_is_valid(title, year):
             flash('Invalid input.') #显示错误提示
-            return redirect(url_for('index')) #重定向回到主页
+            return redirect(url_for('.index')) #重定向回到主页
         #数据合法，存入数据库
-        movie = Movie(title=title, year=year) #创建记录
-        db.session.add(movie)
-        db.session.commit()
+        #创建记录，添加到当前用户的片单；写操作可能在后台线程中执行，用到的值需要事先取出
+        movie = dict(title=title, year=int(year), user_id=current_user.id)
+        if not _write(lambda session: session.add(Movie(**movie))):
+            return redirect(url_for('.index'))
         flash('Item created.') #显示成功创建的提示
         # 此处必须使用重定向，而不能直接渲染html页面
         # 后者会导致该html页面是由POST请求加载的，从而在刷新页面时，仍然发送了POST请求，导致表单重复提交
-        return redirect(url_for('index')) 
-    movies = Movie.query.all()
+        return redirect(url_for('.index')) 
+    #使用键集分页，只读取当前页的记录，而不是 Movie.query.all()
+    per_page = request.args.get('per_page', current_app.config['MOVIES_PER_PAGE'], type=int)
+    per_page = max(1, min(per_page, current_app.config['MOVIES_MAX_PER_PAGE']))
+    sort, after, before = request.args.get('sort', 'id'), request.args.get('after'), request.args.get('before')
+    #流式模式下不分页，边从数据库读取边输出整个列表；可通过配置或查询参数 stream=1/0 切换
+    stream = request.args.get('stream', current_app.config['INDEX_STREAMING'], type=_as_bool)
+    owner_id = current_owner_id()  # 登录用户看自己的片单，访客看主用户的
+
+    #页面内容只取决于程序版本（模板和静态文件）、数据版本、登录用户和分页参数，据此生成 ETag
+    #有待显示的闪现消息时页面内容不可复用，不做条件请求处理
+    version, updated_at = WatchlistVersion.current()
+    build = _build_id()
+    conditional = not session.get('_flashes')
+    if conditional:
+        etag = hashlib.sha1(repr((build, version, updated_at, current_user.get_id(), owner_id,
+                                  sort, after, before, per_page, stream)).encode()).hexdigest()
+        if not is_resource_modified(request.environ, etag=etag, last_modified=updated_at):
+            response = make_response('', 304)
+            return _set_cache_headers(response, etag, updated_at)
+
+    if stream:
+        #闪现消息必须在响应头发出之前从会话中取出，否则流式输出时对会话的修改无法保存
+        get_flashed_messages()
+        body = stream_template('index.html', movies=iter_movies(owner_id, sort, current_app.config['STREAM_BATCH_SIZE']),
+                               total=Movie.count(owner_id))
+        response = current_app.response_class(_buffered(body, current_app.config['STREAM_BUFFER_SIZE']),
+                                              mimetype='text/html')
+        if conditional:
+            _set_cache_headers(response, etag, updated_at)
+        return response
+
+    #电影列表片段按数据版本、片单的主人和登录状态缓存（登录后的列表带有编辑和删除按钮）
+    key = cache_key('movie_list:%s:%d:%s:%d:%d:%s:%s:%s:%d' % (build, version, updated_at, owner_id,
+                                                               current_user.is_authenticated, sort, after, before, per_page))
+    movie_list = cache.get(key)
+    if movie_list is None:
+        page = paginate_movies(owner_id, sort=sort, after=after, before=before, per_page=per_page)
+        movie_list = render_template('_movie_list.html', movies=page.items, page=page)
+        cache.set(key, movie_list, current_app.config['PAGE_CACHE_TTL'])
+
+    response = make_response(render_template('index.html', movie_list=Markup(movie_list), total=Movie.count(owner_id)))
+    if conditional:
+        _set_cache_headers(response, etag, updated_at)
+    return response
+
+def _build_id():
+    #部署新版本后模板或静态文件地址变了，即使数据没有变化，浏览器缓存的旧页面也不能再用
+    #模板的校验和在每个进程中只计算一次（修改模板需要重启），manifest 的校验和在读取 manifest 时已经算好
+    app = current_app._get_current_object()
+    templates = app.extensions.get('watchlist_templates_hash')
+    if templates is None:
+        digest = hashlib.sha1()
+        for name in sorted(app.jinja_env.list_templates()):
+            source = app.jinja_env.loader.get_source(app.jinja_env, name)[0]
+            digest.update(('%s\0%s\0' % (name, source)).encode())
+        templates = app.extensions['watchlist_templates_hash'] = digest.hexdigest()[:12]
+    manifest = app.extensions['watchlist_assets']
+    return '%s-%s' % (templates, manifest['hash'] if manifest else '')
+
+def _as_bool(value):
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+def _buffered(chunks, size):
+    #Jinja 逐个表达式产出很小的字符串片段，合并到一定大小后再发送，减少写入次数
+    buffer, length = [], 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+def _set_cache_headers(response, etag, last_modified):
+    response.set_etag(etag, weak=True)  #压缩等编码变化不影响弱 ETag 的比较
+    if last_modified is not None:
+        response.last_modified = last_modified
+    #要求浏览器和代理每次都用 ETag 重新验证，登录用户的页面只能由浏览器缓存
+    response.cache_control.no_cache = True
+    if current_user.is_authenticated:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    response.vary.add('Cookie')
+    return response
+
+#搜索电影标题，支持前缀匹配和年份过滤
+def _search():
+    limit = request.args.get('limit', current_app.config['MOVIES_PER_PAGE'], type=int)
+    limit = max(1, min(limit, current_app.config['MOVIES_MAX_PER_PAGE']))
+    return search_movies(request.args.get('q', ''), current_owner_id(),
+                         year=request.args.get('year', type=int),
+                         year_from=request.args.get('year_from', type=int),
+                         year_to=request.args.get('year_to', type=int),
+                         limit=limit)
+
+@main.route('/search')
+def search():
+    return render_template('search.html', movies=_search(), q=request.args.get('q', ''))
 
-    return render_template('index.html', movies=movies)
+@main.route('/search.json')
+def search_json():
+    movies = _search()
+    return jsonify(movies=[dict(id=movie.id, title=movie.title, year=movie.year) for movie in movies])
 
 #用户登录页面
-@app.route('/login', methods=['GET', "POST"])
+@main.route('/login', methods=['GET', "POST"])
 def login():
     if request.method == "POST":#接收表单传回的信息
         username = request.form['username']
         password = request.form['password']
         if not username or not password:
             flash('Invalid input.')
-            return redirect(url_for('login'))
-        user = User.query.first()
-        #增加对数据库是否为空的判断
-        if not user:
-            flash('Error, the User Table is Empty.')
-            return redirect(url_for('index')) #重定向到主页
-        #验证输入的用户名和密码和数据库中保存的是否一致
-        if username == user.username and user.validate_password(password):
+            return redirect(url_for('.login'))
+        #在查询数据库和计算密码散列之前先限流
+        wait = login_limiter.check(request.remote_addr, username)
+        if wait:
+            flash('Too many login attempts, please try again later.')
+            return render_template('login.html'), 429, {'Retry-After': str(math.ceil(wait))}
+        #按用户名查找（username 上有唯一索引），不存在的用户名与密码错误给出相同的提示
+        user = User.query.filter_by(username=username).first()
+        #验证输入的密码和数据库中保存的散列值是否一致
+        try:
+            valid = user is not None and user.validate_password(password)
+        except HashingBusy: #散列线程池已满，拒绝本次请求而不是让 worker 排队等待
+            flash('Server busy, please try again.')
+            return render_template('login.html'), 503, {'Retry-After': '1'}
+        if valid:
             login_user(user)
             flash('Login success.')
-            return redirect(url_for('index')) #重定向到主页
+            return redirect(url_for('.index')) #重定向到主页
         
         #验证失败，重定向到登录页面
         flash('Invalid username or password.')
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     
     return render_template('login.html') #对于get请求，直接返回html页面
 
 #用户登出
-@app.route('/logout')
+@main.route('/logout')
 @login_required #用于视图保护，未登录用户不能执行此操作
 def logout():
     logout_user() #登出用户
     flash('Goodbye.')
-    return redirect(url_for('index')) #重定向回首页
+    return redirect(url_for('.index')) #重定向回首页
 
 #设置页面
-@app.route('/settings', methods=['GET', 'POST'])
+@main.route('/settings', methods=['GET', 'POST'])
 @login_required
 def settings():
     if request.method == 'POST':
@@ -73,39 +209,43 @@ def settings():
         #新名称不合法
         if not name or len(name) > 20:
             flash('Invalid input.')
-            return redirect(url_for('settings')) #重定向
+            return redirect(url_for('.settings')) #重定向
         # 新名称合法
-        # 对于已登录的用户，current_user指向当前登录用户的数据库记录对象
-        current_user.name = name #等价于user = User.query.first(); user.name = name
+        # current_user 是缓存中的只读副本，修改前需要从数据库重新读取当前用户的记录
+        # 提交后用户缓存会自动失效
+        user = User.query.get(current_user.id)
+        user.name = name
         db.session.commit()
         flash('Setting updated.')
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
     return render_template('settings.html')
 
 #编辑电影条目
-@app.route('/movie/edit/<int:movie_id>', methods=['GET', 'POST'])
+@main.route('/movie/edit/<int:movie_id>', methods=['GET', 'POST'])
 @login_required #用于视图保护，未登录用户不能执行此操作
 def edit(movie_id):
-    movie = Movie.query.get_or_404(movie_id)
+    movie = Movie.query.filter_by(id=movie_id, user_id=current_user.id).first_or_404()  # 只能编辑自己的电影
     if request.method == "POST":
         title = request.form['title']
         year = request.form['year']
-        if not title or not year or len(year) != 4 or len(title) > 60:
+        if not movie_is_valid(title, year):
             flash('Invalid input.')
-            return redirect(url_for('edit', movie_id=movie_id))  # 重定向回对应的编辑页面
-        movie.title = title  # 更新标题
-        movie.year = year  # 更新年份
-        db.session.commit()  # 提交数据库会话
+            return redirect(url_for('.edit', movie_id=movie_id))  # 重定向回对应的编辑页面
+        def update(session):
+            movie = session.get(Movie, movie_id) or abort(404)  # 写操作使用自己的会话，重新读取记录
+            movie.title = title  # 更新标题
+            movie.year = int(year)  # 更新年份
+        if not _write(update):
+            return redirect(url_for('.edit', movie_id=movie_id))
         flash('Item updated.')
-        return redirect(url_for('index'))  # 重定向回主页
+        return redirect(url_for('.index'))  # 重定向回主页
     return render_template('edit.html', movie=movie)
 
 # 删除电影条目
-@app.route('/movie/delete/<int:movie_id>', methods=['POST'])  # 限定只接受 POST 请求
+@main.route('/movie/delete/<int:movie_id>', methods=['POST'])  # 限定只接受 POST 请求
 @login_required
 def delete(movie_id):
-    movie = Movie.query.get_or_404(movie_id)  # 获取电影记录
-    db.session.delete(movie)  # 删除对应的记录
-    db.session.commit()  # 提交数据库会话
-    flash('Item deleted.')
-    return redirect(url_for('index'))  # 重定向回主页
\ No newline at end of file
+    Movie.query.filter_by(id=movie_id, user_id=current_user.id).first_or_404()  # 确认是当前用户的电影记录
+    if _write(lambda session: session.delete(session.get(Movie, movie_id) or abort(404))):  # 删除对应的记录
+        flash('Item deleted.')
+    return redirect(url_for('.index'))  # 重定向回主页
\ No newline at end of file
@@ -0,0 +1,81 @@
+#冷启动预热：预编译模板、加载字节码缓存、提前完成 ORM 映射配置
+#
+#Jinja 在模板第一次使用时才解析源码并编译成 Python 代码，SQLAlchemy 在第一次查询时才配置映射关系，
+#因此每个新 worker（部署或扩容后）的前几个请求都明显慢于之后的请求。
+#flask compile-templates 把全部模板编译后写入 TEMPLATE_CACHE_DIR（Jinja 的 FileSystemBytecodeCache）；
+#程序启动时若该目录存在就使用它；WARMUP_ON_START 开启时还会在 create_app() 中预先加载全部模板、配置映射，第一个请求不再承担这些开销。
+#wsgi.py 和 asgi.py 默认开启预热；flask 命令行（initdb、import-movies 等）只需要访问数据库，默认不预热。
+#缓存按模板源码的校验和与 Python 版本区分，模板修改后旧的缓存会被忽略，无需手动清理，但重新运行命令可以避免在运行时再编译。
+#启动耗时记录在 app.extensions['watchlist_warmup'] 中，写入日志，并由 /metrics 输出。
+import os
+import time
+
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy.orm import configure_mappers
+
+
+def compile_templates(env, directory, clean=False):
+    """把 env 能找到的全部模板编译后写入 directory，返回模板名列表。"""
+    os.makedirs(directory, exist_ok=True)
+    bytecode_cache = FileSystemBytecodeCache(directory)
+    if clean:
+        bytecode_cache.clear()
+    names = env.list_templates()
+    for name in names:
+        #与 Jinja 加载模板时的步骤相同，只是不经过内存中的模板缓存，已加载过的模板也会重新写入
+        source, filename, uptodate = env.loader.get_source(env, name)
+        bucket = bytecode_cache.get_bucket(env, name, filename, source)
+        bucket.code = env.compile(source, name, filename)
+        bytecode_cache.set_bucket(bucket)
+    return names
+
+
+class Warmup:
+    """Flask 扩展：使用模板字节码缓存，并在 warm() 中完成启动时的预热。"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TEMPLATE_CACHE_DIR', os.path.join(app.instance_path, 'jinja'))
+        app.config.setdefault('WARMUP_ON_START', False)
+        #尚未运行 compile-templates 时不使用字节码缓存，保持 Jinja 默认的行为
+        directory = app.config['TEMPLATE_CACHE_DIR']
+        if directory and os.path.isdir(directory):
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+        app.extensions['watchlist_warmup'] = {'bytecode_cache': app.jinja_env.bytecode_cache is not None,
+                                              'templates': 0, 'template_seconds': 0.0,
+                                              'mapper_seconds': 0.0, 'startup_seconds': None}
+
+    @staticmethod
+    def warm(app, templates=True):
+        """加载全部模板（templates 为 True 时）并配置 ORM 映射，WARMUP_ON_START 为 False 时不做任何事。"""
+        state = app.extensions['watchlist_warmup']
+        if not app.config['WARMUP_ON_START']:
+            return state
+        start = time.perf_counter()
+        configure_mappers()
+        state['mapper_seconds'] = time.perf_counter() - start
+        if templates:
+            start = time.perf_counter()
+            names = app.jinja_env.list_templates()
+            for name in names:
+                app.jinja_env.get_template(name)  # 结果保存在 Jinja 的内存缓存中
+            state['templates'] = len(names)
+            state['template_seconds'] = time.perf_counter() - start
+        return state
+
+    @staticmethod
+    def finish(app, started):
+        """记录从 create_app() 开始到现在的耗时，预热过时写入日志（命令行中不输出）。"""
+        state = app.extensions['watchlist_warmup']
+        state['startup_seconds'] = time.perf_counter() - started
+        if app.config['WARMUP_ON_START']:
+            app.logger.info('Application ready in %.3fs (%d templates in %.3fs%s, mappers in %.3fs).',
+                            state['startup_seconds'], state['templates'], state['template_seconds'],
+                            ' from bytecode cache' if state['bytecode_cache'] else '', state['mapper_seconds'])
+        return state
+
+
+warmup = Warmup()
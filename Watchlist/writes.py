@@ -0,0 +1,131 @@
+#写入合并：把并发的写操作放进队列，由后台线程在一个事务中批量提交
+#
+#SQLite 每次提交都要 fsync，表单请求各自提交时，写入速度受限于磁盘每秒能完成的 fsync 次数。
+#开启 WRITE_COALESCING 后，主页添加、编辑和删除电影的请求把写操作交给后台线程，后台线程等待 WRITE_BATCH_WINDOW 秒
+#（或凑满 WRITE_BATCH_SIZE 个操作）后在一个事务中依次执行，每个操作包在自己的 SAVEPOINT 中：
+#某个操作违反约束时只回滚它自己，其余操作照常提交，整批只 fsync 一次。
+#发起请求的线程等待自己的操作提交完成，得到各自的结果或异常，再决定重定向和闪现消息，与直接提交时的行为相同。
+#未开启时 submit() 直接在当前会话中执行并提交。
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+from flask import current_app
+
+from Watchlist import db
+from Watchlist.database import begin_immediate
+from Watchlist.models import savepoint
+from Watchlist.replica import replica
+
+
+class WriteTimeout(Exception):
+    """写操作在 WRITE_TIMEOUT 秒内没有开始执行，已被取消。"""
+
+
+class WriteQueue:
+    """Flask 扩展：写入合并队列，每个程序实例在第一次使用时启动自己的后台线程。"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('WRITE_COALESCING', False)
+        app.config.setdefault('WRITE_BATCH_SIZE', 64)  # 一个事务最多包含的写操作数
+        app.config.setdefault('WRITE_BATCH_WINDOW', 0.002)  # 秒，收到第一个操作后最多再等待这么久
+        app.config.setdefault('WRITE_TIMEOUT', 5.0)  # 秒，操作排队等待执行的最长时间
+        app.extensions['write_queue'] = {'lock': threading.Lock(), 'queue': None}
+
+    def submit(self, operation):
+        """执行写操作 operation(session)，提交后返回它的返回值；操作或提交失败时抛出相应的异常。
+
+        合并模式下 operation 在后台线程中执行，不能访问请求上下文（current_user 等需要事先取出），
+        返回值应是普通的值而不是 ORM 对象，因为提交后会话会被关闭。
+        """
+        app = current_app._get_current_object()
+        if not app.config['WRITE_COALESCING']:
+            try:
+                result = operation(db.session)
+                db.session.commit()
+            except BaseException:
+                db.session.rollback()
+                raise
+            return result
+        future = Future()
+        self._queue(app).put((operation, future))
+        try:
+            result = future.result(timeout=app.config['WRITE_TIMEOUT'])
+        except TimeoutError:
+            if future.cancel():  # 还没有开始执行，取消后不会再被写入
+                raise WriteTimeout()
+            result = future.result()  # 已经在执行，等待它完成
+        replica.stick_to_primary()
+        return result
+
+    @staticmethod
+    def _queue(app):
+        state = app.extensions['write_queue']
+        with state['lock']:
+            if state['queue'] is None:
+                #在第一次写入时启动线程，gunicorn 等预先 fork 的服务器中每个 worker 进程各有一个
+                state['queue'] = queue.Queue()
+                threading.Thread(target=_worker, args=(app, state['queue']),
+                                 name='write-coalescing', daemon=True).start()
+            return state['queue']
+
+
+def _worker(app, pending):
+    with app.app_context():
+        while True:
+            batch = [pending.get()]
+            deadline = time.monotonic() + app.config['WRITE_BATCH_WINDOW']
+            while len(batch) < app.config['WRITE_BATCH_SIZE']:
+                timeout = deadline - time.monotonic()
+                try:
+                    batch.append(pending.get(timeout=timeout) if timeout > 0 else pending.get_nowait())
+                except queue.Empty:
+                    break
+            #已经超时取消的操作不再执行
+            batch = [(operation, future) for operation, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                _write_batch(batch)
+            except Exception as e:
+                #线程不能因为意外的错误退出，否则等待结果的请求会一直阻塞
+                for operation, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+def _write_batch(batch):
+    session = db.session
+    outcomes = []
+    try:
+        begin_immediate(session())
+        for operation, future in batch:
+            try:
+                with savepoint(session):  # 离开时 flush，违反约束的错误在这里抛出
+                    result = operation(session)
+            except Exception as e:
+                outcomes.append((future, None, e))
+            else:
+                outcomes.append((future, result, None))
+        session.commit()
+    except Exception as e:
+        #提交失败（例如等待写锁超时），整批操作都没有写入
+        session.rollback()
+        for operation, future in batch:
+            future.set_exception(e)
+        return
+    finally:
+        session.remove()
+    for future, result, error in outcomes:
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+
+writes = WriteQueue()
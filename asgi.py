@@ -0,0 +1,16 @@
+#ASGI 入口：电影 API 以异步方式处理，其余页面仍由 Flask 的同步视图处理（见 Watchlist/aio.py）
+#需要 aiosqlite（见 requirements.txt），运行示例：uvicorn asgi:app；同步页面使用的线程数由环境变量 ASGI_THREADS 配置
+import os
+
+from dotenv import load_dotenv
+
+dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
+if os.path.exists(dotenv_path):
+    load_dotenv(dotenv_path)
+#作为服务运行时在启动阶段预热，第一个请求不必编译模板（见 Watchlist/warmup.py）
+os.environ.setdefault('WARMUP_ON_START', '1')
+
+from Watchlist import create_app
+from Watchlist.aio import AsyncApp
+
+app = AsyncApp(create_app())
@@ -0,0 +1,200 @@
+#性能基准测试：使用 Flask 测试客户端测量主要视图和命令行命令的吞吐量、延迟分位数和内存峰值
+#用法示例：
+#   python bench_watchlist.py --movies 1000 --movies 100000 --output bench_results.json
+#   python bench_watchlist.py --movies 1000 --baseline bench_baseline.json --tolerance 0.25
+#指定 --baseline 时与基线结果比较，任何指标变差超过容差都以非零状态码退出，可用于 CI 中阻止性能回退
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from Watchlist import create_app, db, cache
+from Watchlist.commands import forge, initdb
+from Watchlist.models import Movie, User
+
+# 越大越差的指标；rps 是越小越差
+HIGHER_IS_WORSE = ('p50_ms', 'p99_ms', 'peak_kib')
+LOWER_IS_WORSE = ('rps',)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+def measure(func, iterations, memory_iterations):
+    """先计时，再单独开启 tracemalloc 统计内存峰值（tracemalloc 会拖慢执行，不能和计时混在一起）。"""
+    timings = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        begin = time.perf_counter()
+        func(i)
+        timings.append(time.perf_counter() - begin)
+    total = time.perf_counter() - start
+
+    tracemalloc.start()
+    for i in range(memory_iterations):
+        func(iterations + i)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'iterations': iterations,
+        'rps': round(iterations / total, 2),
+        'p50_ms': round(percentile(timings, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(timings, 0.99) * 1000, 3),
+        'mean_ms': round(statistics.fmean(timings) * 1000, 3),
+        'peak_kib': round(peak / 1024, 1),
+    }
+
+
+def seed(count, user_id, batch_size=10000):
+    #与 import-movies 一样使用 executemany 批量插入
+    for start in range(0, count, batch_size):
+        db.session.execute(db.insert(Movie), [
+            {'title': 'Movie %d' % i, 'year': 1900 + i % 120, 'user_id': user_id}
+            for i in range(start, min(count, start + batch_size))
+        ])
+    db.session.commit()
+
+
+def run_size(count, iterations, memory_iterations):
+    results = {}
+    with tempfile.TemporaryDirectory() as path:
+        app = create_app(dict(
+            TESTING=True,
+            SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(path, 'bench.db'),
+            LOGIN_IP_LIMIT=None,  # 基准测试会在短时间内反复登录
+            LOGIN_USERNAME_LIMIT=None,
+        ))
+        with app.app_context():
+            db.create_all()
+            user = User(name='Bench', username='bench')
+            user.set_password('bench')
+            db.session.add(user)
+            db.session.commit()
+
+            begin = time.perf_counter()
+            seed(count, user.id)
+            results['seed'] = {'rows': count, 'rps': round(count / (time.perf_counter() - begin), 2)}
+
+            client = app.test_client()
+            runner = app.test_cli_runner()
+            middle = count // 2
+
+            def get(url, clear_cache=False, headers=None):
+                def request(i):
+                    if clear_cache:
+                        cache.clear()
+                    response = client.get(url, headers=headers)
+                    assert response.status_code == 200, response.status_code
+                return request
+
+            results['index_cached'] = measure(get('/'), iterations, memory_iterations)
+            results['index_gzip'] = measure(get('/', headers={'Accept-Encoding': 'gzip'}), iterations, memory_iterations)
+            results['index_uncached'] = measure(get('/', clear_cache=True), iterations, memory_iterations)
+            results['index_deep_page'] = measure(get('/?after=%d' % middle, clear_cache=True), iterations, memory_iterations)
+            results['index_by_year'] = measure(get('/?sort=year&after=1950.%d' % middle, clear_cache=True),
+                                               iterations, memory_iterations)
+            results['search'] = measure(get('/search.json?q=movie%%20%d' % middle), iterations, memory_iterations)
+
+            #登录涉及有意设计得很慢的密码散列，迭代次数减少
+            def login(i):
+                response = client.post('/login', data={'username': 'bench', 'password': 'bench'})
+                assert response.status_code == 302, response.status_code
+            results['login'] = measure(login, max(1, iterations // 10), 1)
+
+            def create(i):
+                response = client.post('/', data={'title': 'Bench %d' % i, 'year': '2024'})
+                assert response.status_code == 302, response.status_code
+            results['create'] = measure(create, iterations, memory_iterations)
+
+            def edit(i):
+                response = client.post('/movie/edit/%d' % (i % count + 1), data={'title': 'Edited %d' % i, 'year': '2024'})
+                assert response.status_code == 302, response.status_code
+            results['edit'] = measure(edit, iterations, memory_iterations)
+
+            def delete(i):
+                response = client.post('/movie/delete/%d' % (count - i))
+                assert response.status_code == 302, response.status_code
+            results['delete'] = measure(delete, min(iterations, count // 2), min(memory_iterations, count // 4))
+
+            def invoke(command):
+                def run(i):
+                    result = runner.invoke(command)
+                    assert result.exit_code == 0, result.output
+                return run
+            results['initdb'] = measure(invoke(initdb), max(1, iterations // 10), 1)
+            results['forge'] = measure(invoke(forge), max(1, iterations // 10), 1)
+
+            db.session.remove()
+            for engine in db.engines.values():
+                engine.dispose()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """返回所有超出容差的回退项。"""
+    regressions = []
+    for size, scenarios in results['sizes'].items():
+        for scenario, metrics in scenarios.items():
+            base = baseline.get('sizes', {}).get(size, {}).get(scenario)
+            if not base:
+                continue
+            for metric, value in metrics.items():
+                old = base.get(metric)
+                if not old:
+                    continue
+                if metric in HIGHER_IS_WORSE and value > old * (1 + tolerance) or \
+                        metric in LOWER_IS_WORSE and value < old * (1 - tolerance):
+                    regressions.append('%s/%s/%s: %s -> %s' % (size, scenario, metric, old, value))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Watchlist views and CLI commands.')
+    parser.add_argument('--movies', type=int, action='append',
+                        help='Number of movies to seed, may be given several times (default: 1000).')
+    parser.add_argument('--iterations', type=int, default=200, help='Requests per scenario.')
+    parser.add_argument('--memory-iterations', type=int, default=20, help='Requests per scenario traced for peak memory.')
+    parser.add_argument('--output', default='bench_results.json', help='Where to write the JSON results.')
+    parser.add_argument('--baseline', help='Compare against this results file and fail on regressions.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative regression (0.25 = 25%%).')
+    args = parser.parse_args(argv)
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'iterations': args.iterations,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'sizes': {},
+    }
+    for count in args.movies or [1000]:
+        print('Benchmarking with %d movies...' % count, file=sys.stderr)
+        results['sizes'][str(count)] = scenarios = run_size(count, args.iterations, args.memory_iterations)
+        for name, metrics in scenarios.items():
+            print('  %-16s %s' % (name, ', '.join('%s=%s' % item for item in metrics.items())), file=sys.stderr)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print('Performance regressions beyond %d%%:' % (args.tolerance * 100), file=sys.stderr)
+            for line in regressions:
+                print('  ' + line, file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,29 +1,45 @@
+import asyncio
+import gzip
+import importlib.util
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
 import unittest
+from unittest import mock
 
-from Watchlist import app, db
+from sqlalchemy import event, text
+
+from Watchlist import create_app, db
 from Watchlist.models import Movie, User
 from Watchlist.commands import forge, initdb
+from Watchlist.database import engine_options_from_env
 
 class WatchlistTestCase(unittest.TestCase):
     def setUp(self): #该方法在每个测试方法执行之前被调用
-        app.config.update(
+        # 每个测试创建独立的程序实例，使用 SQLite 内存型数据库，不会干扰开发时使用的数据库文件
+        self.app = create_app(dict(
             TESTING=True,
-            SQLALCHEMY_DATABASE_URI='sqlite:///memory:' #此处使用 SQLite 内存型数据库，不会干扰开发时使用的数据库文件
-        )
-        self.app_context = app.app_context()  # 创建应用上下文
+            SQLALCHEMY_DATABASE_URI='sqlite://'
+        ))
+        self.app_context = self.app.app_context()  # 创建应用上下文
         self.app_context.push()  # 激活应用上下文
         #创建数据库和表
         db.create_all()
         #创建测试数据，一个用户记录对象，一个电影条目
         user = User(name='Test', username='test')
         user.set_password('123')
+        db.session.add(user)
+        db.session.flush()  # 分配 user.id
 
-        movie = Movie(title='Test Movie Title', year='2019')
-        db.session.add_all([user, movie])
+        movie = Movie(title='Test Movie Title', year=2019, user_id=user.id)
+        db.session.add(movie)
         db.session.commit()
 
-        self.client = app.test_client() #创建测试客户端，可以通过调用它的get和post方法来模拟客户端的对应请求
-        self.runner = app.test_cli_runner() #创建测试命令运行器
+        self.client = self.app.test_client() #创建测试客户端，可以通过调用它的get和post方法来模拟客户端的对应请求
+        self.runner = self.app.test_cli_runner() #创建测试命令运行器
 
     def tearDown(self): #该方法在每个测试方法执行之后被调用
         db.session.remove() #清除数据库会话
@@ -32,11 +48,21 @@ class WatchlistTestCase(unittest.TestCase):
     
     #测试程序实例是否存在
     def test_app_exist(self):
-        self.assertIsNotNone(app)
+        self.assertIsNotNone(self.app)
     
     #测试程序是否处于测试模式
     def test_app_is_testing(self):
-        self.assertTrue(app.config['TESTING'])
+        self.assertTrue(self.app.config['TESTING'])
+
+    # 测试多个程序实例互不影响，并且只用于命令行的实例不会注册视图
+    def test_app_factory(self):
+        other = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite://'), with_views=False)
+        self.assertNotIn('main.index', other.view_functions)
+        self.assertIn('initdb', other.cli.commands)
+        with other.app_context():
+            db.create_all()
+            self.assertEqual(Movie.query.count(), 0)
+        self.assertEqual(Movie.query.count(), 1)
 
     # 测试404页面
     def test_404_page(self):
@@ -46,6 +72,24 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertIn('Go Back', data)
         self.assertEqual(response.status_code, 404)  # 判断响应状态码
     
+    # 测试 SQLite 连接建立时应用的 PRAGMA
+    def test_sqlite_pragmas(self):
+        # 内存数据库不支持 WAL，这里使用临时文件
+        with tempfile.TemporaryDirectory() as path:
+            app = create_app(dict(SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(path, 'test.db')), with_views=False)
+            with app.app_context():
+                self.assertEqual(db.session.execute(text('PRAGMA busy_timeout')).scalar(), 5000)
+                self.assertEqual(db.session.execute(text('PRAGMA synchronous')).scalar(), 1)  # 1 即 NORMAL
+                self.assertEqual(db.session.execute(text('PRAGMA journal_mode')).scalar(), 'wal')
+                db.session.remove()
+                db.engine.dispose()
+
+    # 测试通过环境变量配置连接池
+    def test_engine_options_from_env(self):
+        with mock.patch.dict(os.environ, {'DATABASE_POOL_SIZE': '10', 'DATABASE_POOL_PRE_PING': 'true'}):
+            options = engine_options_from_env()
+        self.assertEqual(options, {'pool_size': 10, 'pool_pre_ping': True})
+
     # 测试主页
     def test_index_page(self):
         response = self.client.get('/')
@@ -54,7 +98,418 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertIn('Test Movie Title', data)
         self.assertEqual(response.status_code, 200)
 
-    
+    # 测试主页分页
+    def test_index_pagination(self):
+        db.session.add_all([Movie(title='Movie %d' % i, year=2000 + i, user_id=1) for i in range(5)])
+        db.session.commit()
+
+        response = self.client.get('/?per_page=2')
+        data = response.get_data(as_text=True)
+        self.assertIn('6 Titles', data)
+        self.assertIn('Test Movie Title', data)
+        self.assertIn('Movie 0', data)
+        self.assertNotIn('Movie 1', data)
+        self.assertIn('Next', data)
+        self.assertNotIn('Prev', data)
+
+        response = self.client.get('/?per_page=2&after=2')
+        data = response.get_data(as_text=True)
+        self.assertIn('Movie 1', data)
+        self.assertIn('Movie 2', data)
+        self.assertNotIn('Movie 0', data)
+        self.assertIn('Prev', data)
+
+        response = self.client.get('/?per_page=2&before=4')
+        data = response.get_data(as_text=True)
+        self.assertIn('Movie 1', data)
+        self.assertIn('Movie 0', data)
+        self.assertNotIn('Movie 2', data)
+
+        # 按年份排序，游标由年份和 id 组成
+        response = self.client.get('/?per_page=2&sort=year&after=2001.3')
+        data = response.get_data(as_text=True)
+        self.assertIn('Movie 2', data)
+        self.assertIn('Movie 3', data)
+        self.assertNotIn('Movie 1', data)
+
+    # 测试主页的流式输出
+    def test_index_streaming(self):
+        db.session.add_all([Movie(title='Movie %d' % i, year=2000 + i, user_id=1) for i in range(5)])
+        db.session.commit()
+        self.app.config['STREAM_BUFFER_SIZE'] = 1
+
+        # 流式响应事先不知道长度，因此没有 Content-Length 头
+        response = self.client.get('/?stream=1&per_page=2')
+        self.assertNotIn('Content-Length', response.headers)
+        data = response.get_data(as_text=True)
+        self.assertIn('6 Titles', data)
+        self.assertIn('Movie 4', data)  # 流式模式不分页
+        self.assertNotIn('Next', data)
+
+        # 通过配置默认开启，查询参数可以关闭
+        self.app.config['INDEX_STREAMING'] = True
+        self.assertNotIn('Content-Length', self.client.get('/').headers)
+        self.assertIn('Content-Length', self.client.get('/?stream=0').headers)
+
+        # 闪现消息在流式输出时也只显示一次
+        self.client.post('/login', data=dict(username='test', password='123'))
+        response = self.client.get('/')
+        self.assertIn('Login success.', response.get_data(as_text=True))
+        self.assertIn('Edit', response.get_data(as_text=True))
+        response = self.client.get('/')
+        self.assertNotIn('Login success.', response.get_data(as_text=True))
+
+    # 测试响应压缩：按 Accept-Encoding 协商，压缩结果按 ETag 缓存，流式响应逐块压缩
+    def test_compression(self):
+        response = self.client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertIn('Test Movie Title', gzip.decompress(response.get_data()).decode())
+        # 同一个页面再次访问时使用缓存的压缩结果
+        with mock.patch('Watchlist.compression.zlib.compress') as compress:
+            response = self.client.get('/', headers={'Accept-Encoding': 'gzip'})
+        compress.assert_not_called()
+        self.assertIn('Test Movie Title', gzip.decompress(response.get_data()).decode())
+
+        self.assertNotIn('Content-Encoding', self.client.get('/').headers)
+        response = self.client.get('/?stream=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Test Movie Title', gzip.decompress(response.get_data()).decode())
+
+        self.app.config['COMPRESS_MIN_SIZE'] = 1024 * 1024
+        self.assertNotIn('Content-Encoding', self.client.get('/', headers={'Accept-Encoding': 'gzip'}).headers)
+
+        from Watchlist.compression import brotli
+        if brotli is not None:
+            response = self.client.get('/?stream=1', headers={'Accept-Encoding': 'gzip, br'})
+            self.assertEqual(response.headers['Content-Encoding'], 'br')
+            self.assertIn('Test Movie Title', brotli.decompress(response.get_data()).decode())
+
+    # 测试电影总数缓存在写入后失效
+    def test_movie_count_cache(self):
+        self.assertEqual(Movie.count(1), 1)
+        db.session.add(Movie(title='Another Movie', year=2020, user_id=1))
+        db.session.commit()
+        self.assertEqual(Movie.count(1), 2)
+
+    # 测试用户缓存：页面预热后，再次访问不应再查询 user 表
+    def test_user_cache(self):
+        self.login()
+        self.client.get('/')
+
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            response = self.client.get('/')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertIn('Test\'s Watchlist', response.get_data(as_text=True))
+        self.assertFalse([s for s in statements if 'FROM user' in s])
+
+        # 修改名称后缓存失效，页面显示新名称
+        self.client.post('/settings', data=dict(name='Cached'))
+        response = self.client.get('/')
+        self.assertIn('Cached\'s Watchlist', response.get_data(as_text=True))
+
+    # 测试服务器端会话：Cookie 中只有会话 ID，用户对象缓存在会话中，登出和修改设置后失效；每个请求按主键确认会话仍然存在
+    def test_server_session(self):
+        from Watchlist.models import ServerSessionRecord
+        from Watchlist.sessions import server_sessions
+        self.app.config['SESSION_BACKEND'] = 'server'
+        server_sessions.init_app(self.app)
+        self.client.post('/login', data=dict(username='test', password='123'))
+        cookie = self.client.get_cookie('session').value
+        self.assertNotIn('_user_id', cookie)
+        self.assertEqual(ServerSessionRecord.query.count(), 1)
+        self.client.get('/settings')  # 加载用户对象并缓存在会话中
+
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            with mock.patch.object(User, 'get_cached') as get_cached:
+                response = self.client.get('/settings')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertIn('value="Test"', response.get_data(as_text=True))
+        get_cached.assert_not_called()
+        statements = [s for s in statements if 'server_session' in s]
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith('SELECT'))
+
+        # 修改名称后会话中缓存的用户对象失效；闪现消息原地更新会话，不换 ID，并发请求中的旧 Cookie 仍然有效
+        self.client.post('/settings', data=dict(name='Renamed'))
+        self.assertEqual(self.client.get_cookie('session').value, cookie)
+        self.assertIn('value="Renamed"', self.client.get('/settings').get_data(as_text=True))
+        self.assertEqual(ServerSessionRecord.query.count(), 1)
+
+        # 登出后旧的会话 ID 不再有效
+        self.client.get('/logout')
+        self.assertNotEqual(self.client.get_cookie('session').value, cookie)
+        self.client.set_cookie('session', cookie)
+        response = self.client.get('/settings')
+        self.assertEqual(response.status_code, 302)
+
+    # 测试多个 worker 共享会话表：一个 worker 上登出后，其他 worker 缓存中的会话立即失效
+    def test_server_session_logout_other_worker(self):
+        with tempfile.TemporaryDirectory() as path:
+            config = dict(TESTING=True, SESSION_BACKEND='server',
+                          SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(path, 'test.db'))
+            first, second = create_app(config), create_app(config)
+            with first.app_context():
+                db.create_all()
+                user = User(name='Test', username='test')
+                user.set_password('123')
+                db.session.add(user)
+                db.session.commit()
+                db.session.remove()
+            a, b = first.test_client(), second.test_client()
+            a.post('/login', data=dict(username='test', password='123'))
+            cookie = a.get_cookie('session').value
+            b.set_cookie('session', cookie)
+            self.assertEqual(b.get('/settings').status_code, 200)  # b 的缓存中有了该会话
+
+            a.get('/logout')
+            self.assertEqual(b.get('/settings').status_code, 302)
+            for app in (first, second):
+                with app.app_context():
+                    db.engine.dispose()
+
+    # 测试主页的条件请求和片段缓存
+    def test_index_conditional_get(self):
+        response = self.client.get('/')
+        etag = response.headers['ETag']
+        self.assertIsNotNone(response.last_modified)
+
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+
+        # 修改电影后版本号改变，旧的 ETag 失效，列表重新渲染
+        movie = Movie.query.get(1)
+        movie.title = 'Changed Title'
+        db.session.commit()
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIn('Changed Title', response.get_data(as_text=True))
+
+        # 登录前后的页面内容不同，ETag 也不同
+        self.login()
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Edit', response.get_data(as_text=True))
+
+        # 模板或静态文件变化（重新部署、重新构建）后，数据没有变化的页面也不再返回 304
+        etag = response.headers['ETag']
+        self.app.extensions['watchlist_templates_hash'] = 'changed'
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        etag = response.headers['ETag']
+        self.app.extensions['watchlist_assets'] = {'files': {}, 'built': set(), 'encodings': {}, 'images': {},
+                                                   'hash': 'rebuilt'}
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    # 测试全文搜索，索引随增删改自动同步
+    def test_search(self):
+        db.session.add_all([Movie(title='The Matrix', year=1999, user_id=1),
+                            Movie(title='The Matrix Reloaded', year=2003, user_id=1),
+                            Movie(title='Leon', year=1994, user_id=1)])
+        db.session.commit()
+
+        response = self.client.get('/search.json?q=matr')
+        titles = [movie['title'] for movie in response.get_json()['movies']]
+        self.assertEqual(sorted(titles), ['The Matrix', 'The Matrix Reloaded'])
+
+        response = self.client.get('/search.json?q=matrix&year=2003')
+        self.assertEqual([m['title'] for m in response.get_json()['movies']], ['The Matrix Reloaded'])
+
+        movie = Movie.query.filter_by(title='Leon').first()
+        movie.title = 'Leon The Professional'
+        db.session.commit()
+        response = self.client.get('/search?q=profess')
+        data = response.get_data(as_text=True)
+        self.assertIn('1 Results', data)
+        self.assertIn('Leon The Professional', data)
+
+        db.session.delete(movie)
+        db.session.commit()
+        response = self.client.get('/search.json?q=leon')
+        self.assertEqual(response.get_json()['movies'], [])
+
+        # 特殊字符不会被当作 FTS5 语法解析
+        response = self.client.get('/search.json?q="OR*(')
+        self.assertEqual(response.status_code, 200)
+
+    # 测试 JSON API 的读取接口
+    def test_api_read(self):
+        response = self.client.get('/api/movies')
+        data = response.get_json()
+        self.assertEqual(data['total'], 1)
+        self.assertEqual(data['movies'], [{'id': 1, 'title': 'Test Movie Title', 'year': 2019}])
+        self.assertIsNone(data['next'])
+
+        response = self.client.get('/api/movies/1')
+        self.assertEqual(response.get_json()['title'], 'Test Movie Title')
+        response = self.client.get('/api/movies/42')
+        self.assertEqual(response.status_code, 404)
+
+    # 测试 JSON API 的批量写入，部分失败的条目逐条报告
+    def test_api_batch_write(self):
+        response = self.client.post('/api/movies', json=[{'title': 'A', 'year': '2001'}])
+        self.assertEqual(response.status_code, 401)
+
+        self.login()
+        response = self.client.post('/api/movies', json=[
+            {'title': 'API One', 'year': '2001'},
+            {'title': '', 'year': '2002'},
+            {'title': 'API Two', 'year': 2002},
+        ])
+        self.assertEqual(response.status_code, 207)
+        results = response.get_json()['results']
+        self.assertEqual([r['ok'] for r in results], [True, False, True])
+        self.assertEqual(results[1]['error'], 'Invalid input.')
+        self.assertEqual(results[2]['movie']['year'], 2002)
+        self.assertEqual(Movie.count(1), 3)
+
+        response = self.client.patch('/api/movies', json={'movies': [
+            {'id': 1, 'title': 'Patched'},
+            {'id': 99, 'title': 'Missing'},
+            {'id': 1, 'year': '20'},
+            {'id': 1, 'year': '²⁰⁰⁰'},
+            {'id': [1], 'title': 'Unhashable'},
+            {'id': True, 'title': 'Boolean'},
+        ]})
+        results = response.get_json()['results']
+        self.assertEqual([r['ok'] for r in results], [True, False, False, False, False, False])
+        self.assertEqual(results[4]['error'], 'Movie not found.')
+        self.assertEqual(results[5]['error'], 'Movie not found.')
+        self.assertEqual(Movie.query.get(1).title, 'Patched')
+        self.assertEqual(Movie.query.get(1).year, 2019)
+
+        response = self.client.delete('/api/movies', json={'ids': [True]})
+        self.assertEqual(response.get_json()['failed'], 1)
+        self.assertIsNotNone(Movie.query.get(1))
+
+        response = self.client.delete('/api/movies', json={'ids': [1, 99]})
+        self.assertEqual(response.get_json()['failed'], 1)
+        self.assertIsNone(Movie.query.get(1))
+
+        response = self.client.post('/api/movies', json={'title': 'Not a list'})
+        self.assertEqual(response.status_code, 400)
+
+    # 测试 ASGI 模式：电影 API 由异步数据库层处理，其余页面交给 Flask
+    @unittest.skipUnless(importlib.util.find_spec('aiosqlite'), 'aiosqlite is required')
+    def test_asgi(self):
+        from Watchlist.aio import AsyncApp
+
+        def call(app, method, path, body=b'', headers=()):
+            async def run():
+                result = await request(app, method, path, body, headers)
+                await app.engine.dispose()  # 每次调用都使用新的事件循环，连接不能跨循环复用
+                return result
+            return asyncio.run(run())
+
+        async def request(app, method, path, body=b'', headers=()):
+            messages = []
+            async def receive():
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            async def send(message):
+                messages.append(message)
+            path_info, _, query = path.partition('?')
+            await app({'type': 'http', 'method': method, 'path': path_info, 'root_path': '',
+                       'query_string': query.encode(), 'headers': list(headers), 'scheme': 'http',
+                       'server': ('localhost', 80), 'client': ('127.0.0.1', 5000), 'http_version': '1.1'},
+                      receive, send)
+            return messages[0]['status'], b''.join(m.get('body', b'') for m in messages[1:])
+
+        with tempfile.TemporaryDirectory() as path:
+            flask_app = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(path, 'asgi.db')))
+            # ASGI 服务器中没有预先推送的程序上下文，这里也只在准备数据和检查结果时推送
+            with flask_app.app_context():
+                db.create_all()
+                user = User(name='Async', username='async')
+                user.set_password('123')
+                db.session.add(user)
+                db.session.flush()
+                db.session.add(Movie(title='Sync Movie', year=2000, user_id=user.id))
+                db.session.commit()
+            client = flask_app.test_client()
+            client.post('/login', data=dict(username='async', password='123'))
+            cookie = (b'cookie', b'session=' + client.get_cookie('session').value.encode())
+            json_type = (b'content-type', b'application/json')
+            app = AsyncApp(flask_app)
+
+            status, body = call(app, 'GET', '/api/movies?per_page=1')
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body)['movies'][0]['title'], 'Sync Movie')
+
+            payload = json.dumps([{'title': 'Async Movie', 'year': '2024'}, {'title': ''}]).encode()
+            status, body = call(app, 'POST', '/api/movies', payload, [json_type])
+            self.assertEqual(status, 401)
+            status, body = call(app, 'POST', '/api/movies', payload, [json_type, cookie])
+            self.assertEqual(status, 207)
+            movie_id = json.loads(body)['results'][0]['movie']['id']
+
+            # 异步写入后，同步程序中的缓存同样失效
+            self.assertEqual(client.get('/api/movies').get_json()['total'], 2)
+            payload = json.dumps([{'id': movie_id, 'year': '2025'}]).encode()
+            status, body = call(app, 'PATCH', '/api/movies', payload, [json_type, cookie])
+            self.assertEqual(status, 200)
+            self.assertEqual(client.get('/api/movies/%d' % movie_id).get_json()['year'], 2025)
+            status, body = call(app, 'DELETE', '/api/movies', b'[%d]' % movie_id, [json_type, cookie])
+            self.assertEqual(status, 200)
+            status, body = call(app, 'GET', '/api/movies/%d' % movie_id)
+            self.assertEqual(status, 404)
+
+            # 非 API 的页面由 Flask 的同步视图处理
+            status, body = call(app, 'GET', '/')
+            self.assertEqual(status, 200)
+            self.assertIn(b'1 Titles', body)
+
+            # 同步页面在线程池中并发执行：两个请求必须同时在执行，barrier 才能通过
+            barrier = threading.Barrier(2, timeout=5)
+            with mock.patch.dict(flask_app.view_functions, {'main.index': lambda: str(barrier.wait())}):
+                async def concurrent():
+                    return await asyncio.gather(request(app, 'GET', '/'), request(app, 'GET', '/'))
+                results = asyncio.run(concurrent())
+            self.assertEqual(sorted(results), [(200, b'0'), (200, b'1')])
+            app.executor.shutdown()
+            with flask_app.app_context():
+                for engine in db.engines.values():
+                    engine.dispose()
+
+    # 测试性能指标
+    def test_metrics(self):
+        self.app.config['METRICS_SERVER_TIMING'] = True
+        response = self.client.get('/')
+        self.assertIn('db;dur=', response.headers['Server-Timing'])
+        self.client.get('/nothing')
+
+        response = self.client.get('/metrics')
+        data = response.get_data(as_text=True)
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertIn('watchlist_requests_total{endpoint="main.index",method="GET",status="200"} 1', data)
+        self.assertIn('watchlist_requests_total{endpoint="none",method="GET",status="404"} 1', data)
+        self.assertIn('watchlist_request_duration_seconds_count{endpoint="main.index"} 1', data)
+        self.assertIn('watchlist_request_sql_queries_bucket{endpoint="main.index",le="+Inf"} 1', data)
+        self.assertIn('watchlist_template_render_seconds_total{endpoint="main.index"}', data)
+
+    # 测试基准测试结果与基线的比较
+    def test_benchmark_compare(self):
+        from bench_watchlist import compare
+        baseline = {'sizes': {'1000': {'index_cached': {'p99_ms': 10.0, 'rps': 100.0}}}}
+        results = {'sizes': {'1000': {'index_cached': {'p99_ms': 11.0, 'rps': 95.0}}}}
+        self.assertEqual(compare(results, baseline, 0.2), [])
+        results = {'sizes': {'1000': {'index_cached': {'p99_ms': 13.0, 'rps': 70.0}}}}
+        self.assertEqual(len(compare(results, baseline, 0.2)), 2)
+
     # 辅助方法，用于登入用户
     def login(self):
         self.client.post('/login', data=dict(
@@ -93,6 +548,10 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertNotIn('Item created.', data)
         self.assertIn('Invalid input.', data)
 
+        #isdigit() 为真但 int() 无法转换的年份
+        response = self.client.post('/', data=dict(title='New Movie', year='²⁰⁰⁰'), follow_redirects=True)
+        self.assertIn('Invalid input.', response.get_data(as_text=True))
+
     #测试更新条目
     def test_update_item(self):
         self.login()
@@ -202,6 +661,76 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertNotIn('Login success.', data)
         self.assertIn('Invalid input.', data)
 
+    # 测试多用户：每个用户只能看到和修改自己的片单，访客看到的是主用户的片单
+    def test_multi_user(self):
+        result = self.runner.invoke(args=['add-user', '--username', 'alice', '--password', '456'])
+        self.assertIn('Created user alice.', result.output)
+        result = self.runner.invoke(args=['add-user', '--username', 'alice', '--password', '456'])
+        self.assertIn('User alice already exists.', result.output)
+        alice = User.query.filter_by(username='alice').first()
+        db.session.add(Movie(title='Alice Movie', year=2001, user_id=alice.id))
+        db.session.commit()
+        alice_movie = Movie.query.filter_by(title='Alice Movie').first().id
+
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Test Movie Title', data)
+        self.assertNotIn('Alice Movie', data)
+
+        self.client.post('/login', data=dict(username='alice', password='456'))
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('alice\'s Watchlist', data)
+        self.assertIn('Alice Movie', data)
+        self.assertNotIn('Test Movie Title', data)
+        self.assertIn('1 Titles', data)
+        self.assertEqual([m['title'] for m in self.client.get('/api/movies').get_json()['movies']], ['Alice Movie'])
+        self.assertEqual(self.client.get('/api/movies/1').status_code, 404)
+        self.assertEqual(self.client.get('/search.json?q=movie').get_json()['movies'][0]['title'], 'Alice Movie')
+
+        # 其他用户的电影视为不存在
+        self.assertEqual(self.client.get('/movie/edit/1').status_code, 404)
+        self.assertEqual(self.client.post('/movie/delete/1').status_code, 404)
+        response = self.client.patch('/api/movies', json=[{'id': 1, 'title': 'Hacked'}])
+        self.assertEqual(response.get_json()['results'][0]['error'], 'Movie not found.')
+        self.assertEqual(Movie.query.get(1).title, 'Test Movie Title')
+
+        self.client.post('/', data=dict(title='Alice Second', year='2002'))
+        self.assertEqual(Movie.query.filter_by(title='Alice Second').first().user_id, alice.id)
+        self.client.post('/movie/delete/%d' % alice_movie)
+        self.assertIsNone(Movie.query.get(alice_movie))
+        self.assertEqual(Movie.count(alice.id), 1)
+        self.assertEqual(Movie.count(1), 1)
+
+    # 测试登录限流，同一用户名连续失败超过限额后返回 429
+    def test_login_rate_limit(self):
+        self.app.config['LOGIN_USERNAME_LIMIT'] = (2, 60)
+        from Watchlist.security import login_limiter
+        login_limiter.init_app(self.app)
+        for i in range(2):
+            response = self.client.post('/login', data=dict(username='test', password='456'))
+            self.assertEqual(response.status_code, 302)
+        response = self.client.post('/login', data=dict(username='test', password='123'))
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+        self.assertIn('Too many login attempts', response.get_data(as_text=True))
+        # 其他用户名不受影响
+        response = self.client.post('/login', data=dict(username='other', password='123'))
+        self.assertEqual(response.status_code, 302)
+
+    # 测试散列线程池已满时登录返回 503
+    def test_login_hashing_busy(self):
+        from Watchlist.security import HashingBusy, hasher
+        with mock.patch.object(hasher, '_run', side_effect=HashingBusy):
+            response = self.client.post('/login', data=dict(username='test', password='123'))
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+        self.app.config.update(HASH_WORKERS=1, HASH_MAX_PENDING=0)
+        hasher.init_app(self.app)
+        slots = self.app.extensions['password_hasher']['slots']
+        slots.acquire()  # 占用唯一的名额
+        self.assertRaises(HashingBusy, hasher.generate, '123')
+        slots.release()
+        self.assertTrue(hasher.check(hasher.generate('123'), '123'))
+
     # 测试登出，用户登出后，页面被重定向到主页
     def test_logout(self):
         self.login()
@@ -254,6 +783,275 @@ class WatchlistTestCase(unittest.TestCase):
         result = self.runner.invoke(initdb)
         self.assertIn('Initialized database.', result.output)
 
+    # 测试批量导入电影数据，不合法的行会被跳过
+    def test_import_movies_command(self):
+        from sqlalchemy.exc import IntegrityError
+
+        with self.runner.isolated_filesystem():
+            with open('movies.csv', 'w') as f:
+                f.write('title,year\nImported One,2001\nImported Two,2002\n,2003\nBad Year,20\nBaz,1e3\n')
+            result = self.runner.invoke(args=['import-movies', 'movies.csv', '--batch-size', '1', '--commit-size', '1'])
+            self.assertIn('Imported 2 movies, skipped 3 invalid rows', result.output)
+
+            with open('movies.jsonl', 'w') as f:
+                f.write('{"title": "Imported Three", "year": "2003"}\n\n[1, 2]\n{"title": \n'
+                        '{"title": "Half", "year": 2019.5}\n')
+            result = self.runner.invoke(args=['import-movies', 'movies.jsonl'])
+            self.assertIn('Imported 1 movies, skipped 3 invalid rows', result.output)
+        self.assertEqual(Movie.query.count(), 4)
+        self.assertEqual(Movie.count(1), 4)
+        self.assertIsNotNone(Movie.query.filter_by(title='Imported Three', year='2003').first())
+        self.assertEqual(db.session.execute(text('SELECT count(*) FROM movie WHERE typeof(year) != \'integer\'')).scalar(), 0)
+        #数据库本身也拒绝小数年份
+        self.assertRaises(IntegrityError, db.session.execute, text('UPDATE movie SET year = 2019.5 WHERE id = 1'))
+        db.session.rollback()
+
+    # 测试导出电影数据
+    def test_export_movies_command(self):
+        result = self.runner.invoke(args=['export-movies', '--format', 'jsonl'])
+        self.assertIn('{"id": 1, "title": "Test Movie Title", "year": 2019}', result.output)
+        result = self.runner.invoke(args=['export-movies'])
+        self.assertIn('id,title,year', result.output)
+        self.assertIn('1,Test Movie Title,2019', result.output)
+
+    # 测试数据库结构迁移：旧数据库的 year 字符串列转换为带 CHECK 约束的整数列，已有的电影分配给主用户，可选的唯一索引
+    def test_migrate_command(self):
+        from Watchlist import migrations
+        from Watchlist.search import create_index, search_movies
+        from sqlalchemy.exc import IntegrityError
+
+        self.assertTrue(migrations.year_is_integer())  # create_all() 创建的就是新结构
+        with tempfile.TemporaryDirectory() as path:
+            app = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(path, 'old.db')))
+            runner = app.test_cli_runner()
+            with app.app_context():
+                with db.engine.begin() as connection:
+                    connection.exec_driver_sql('CREATE TABLE movie (id INTEGER PRIMARY KEY, title VARCHAR(60), year VARCHAR(4))')
+                    connection.exec_driver_sql("INSERT INTO movie (title, year) VALUES "
+                                               "('Old One', '2001'), ('Old Two', ' 2002'), ('Old One', '2001'), "
+                                               "('Bad Year', '20x'), ('', '2003')")
+                create_index()
+                self.assertFalse(migrations.year_is_integer())
+
+                result = runner.invoke(args=['migrate'])
+                self.assertIn('2 movies have an empty or too long title', result.output)
+                self.assertEqual(db.session.execute(text('SELECT count(*) FROM movie')).scalar(), 5)
+                db.session.remove()
+
+                result = runner.invoke(args=['migrate', '--drop-invalid', '--batch-size', '2'])
+                self.assertIn('dropped 2 invalid movies', result.output)
+                self.assertTrue(migrations.year_is_integer())
+                self.assertIn('create one with flask admin', result.output)  # 还没有用户，电影无法分配
+
+                runner.invoke(args=['admin', '--username', 'old', '--password', '123'])
+                result = runner.invoke(args=['migrate', '--batch-size', '2'])
+                self.assertIn('assigned 3 movies to user 1', result.output)
+                self.assertIn('Database is up to date.', result.output)
+                self.assertEqual(sorted((m.title, m.year, m.user_id) for m in Movie.query),
+                                 [('Old One', 2001, 1), ('Old One', 2001, 1), ('Old Two', 2002, 1)])
+                self.assertEqual([m.title for m in search_movies('two', 1)], ['Old Two'])
+                db.session.add(Movie(title='Too Old', year=999, user_id=1))
+                self.assertRaises(IntegrityError, db.session.commit)
+                db.session.rollback()
+
+                result = runner.invoke(args=['migrate', '--unique'])
+                self.assertIn('1 (title, year) pairs appear more than once', result.output)
+                db.session.delete(Movie.query.get(3))
+                db.session.commit()
+                result = runner.invoke(args=['migrate', '--unique'])
+                self.assertIn('Database is up to date.', result.output)
+                result = runner.invoke(args=['migrate', '--status'])
+                self.assertIn('[x] movie_year_integer', result.output)
+                self.assertIn('[x] movie_owner', result.output)
+                self.assertIn('[x] movie_title_year_unique', result.output)
+
+            client = app.test_client()
+            client.post('/login', data=dict(username='old', password='123'))
+            response = client.post('/', data=dict(title='Old Two', year='2002'), follow_redirects=True)
+            self.assertIn('This movie is already in the list.', response.get_data(as_text=True))
+            # API 中重复的条目单独报告为失败，同一批次的其他条目照常写入
+            response = client.post('/api/movies', json=[{'title': 'Old Two', 'year': 2002}, {'title': 'Old Three', 'year': 2003}])
+            self.assertEqual(response.status_code, 207)
+            results = response.get_json()['results']
+            self.assertEqual(results[0], {'index': 0, 'ok': False, 'error': 'This movie is already in the list.'})
+            self.assertTrue(results[1]['ok'])
+            response = client.patch('/api/movies', json=[{'id': results[1]['movie']['id'], 'title': 'Old Two', 'year': 2002},
+                                                         {'id': 1, 'title': 'Old One Renamed'}])
+            self.assertEqual([r['ok'] for r in response.get_json()['results']], [False, True])
+            self.assertEqual(client.get('/api/movies/1').get_json()['title'], 'Old One Renamed')
+            with app.app_context():
+                db.engine.dispose()
+
+    # 测试写入合并：并发的写操作在一个事务中提交，失败的操作不影响同一批次的其他操作
+    def test_write_coalescing(self):
+        import threading
+        import time
+        from sqlalchemy.exc import IntegrityError
+        from Watchlist.models import WatchlistVersion
+        from Watchlist.writes import writes
+        self.app.config.update(WRITE_COALESCING=True, WRITE_BATCH_WINDOW=0.2)
+        version = WatchlistVersion.current()[0]
+        commits, errors = [], {}
+        event.listen(db.engine, 'commit', lambda conn: commits.append(1))
+
+        def submit(i):
+            with self.app.app_context():
+                try:
+                    # 第一个操作违反 CHECK 约束，它的 SAVEPOINT 回滚后，后面的操作仍需更新版本号
+                    writes.submit(lambda session: session.add(Movie(title='Batch %d' % i, year=999 if i == 0 else 2000, user_id=1)))
+                except IntegrityError as e:
+                    errors[i] = e
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(5)]
+        threads[0].start()
+        time.sleep(0.05)
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(list(errors), [0])
+        self.assertEqual(len(commits), 1)
+        self.assertEqual(Movie.query.filter(Movie.title.like('Batch %')).count(), 4)
+        self.assertEqual(Movie.count(1), 5)
+        self.assertEqual(WatchlistVersion.current()[0], version + 1)
+
+        # 表单请求等待各自的结果后再显示消息
+        self.app.config['WRITE_BATCH_WINDOW'] = 0.002
+        self.login()
+        data = self.client.post('/', data=dict(title='Queued', year='2011'), follow_redirects=True).get_data(as_text=True)
+        self.assertIn('Item created.', data)
+        self.assertIn('Queued', data)
+        movie_id = Movie.query.filter_by(title='Queued').first().id
+        data = self.client.post('/movie/edit/%d' % movie_id, data=dict(title='Requeued', year='2012'),
+                                follow_redirects=True).get_data(as_text=True)
+        self.assertIn('Item updated.', data)
+        self.assertIn('Requeued', data)
+        data = self.client.post('/movie/delete/%d' % movie_id, follow_redirects=True).get_data(as_text=True)
+        self.assertIn('Item deleted.', data)
+        self.assertNotIn('Requeued', data)
+
+    # 测试读写分离：GET 请求读取快照，写入主数据库，写入后的用户暂时读主数据库
+    def test_read_replica(self):
+        from sqlalchemy.exc import OperationalError
+        with tempfile.TemporaryDirectory() as path:
+            primary, copy = os.path.join(path, 'primary.db'), os.path.join(path, 'snapshot.db')
+            app = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///' + primary, READ_REPLICA=copy))
+            with app.app_context():
+                db.create_all()
+                user = User(name='Replica', username='replica')
+                user.set_password('123')
+                db.session.add(user)
+                db.session.flush()
+                db.session.add(Movie(title='Before Snapshot', year=2001, user_id=user.id))
+                db.session.commit()
+                result = app.test_cli_runner().invoke(args=['snapshot', copy])
+                self.assertIn('Snapshot written to', result.output)
+                db.session.add(Movie(title='After Snapshot', year=2002, user_id=user.id))
+                db.session.commit()
+
+            data = app.test_client().get('/').get_data(as_text=True)
+            self.assertIn('Before Snapshot', data)
+            self.assertNotIn('After Snapshot', data)
+
+            client = app.test_client()
+            client.post('/login', data=dict(username='replica', password='123'))
+            client.post('/', data=dict(title='Written', year='2003'))
+            # 匿名访客读快照时填充的缓存不会被读主数据库的请求使用，反之亦然
+            anonymous = app.test_client()
+            etag = anonymous.get('/').headers['ETag']
+            data = client.get('/').get_data(as_text=True)
+            self.assertIn('Written', data)
+            self.assertIn('After Snapshot', data)
+            self.assertIn('3 Titles', data)
+            response = anonymous.get('/', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertIn('1 Titles', anonymous.get('/').get_data(as_text=True))
+
+            with app.app_context():
+                db.session.remove()
+                db.engine.dispose()
+                app.extensions['watchlist_replica']['engine'].dispose()
+
+            # 同时使用服务器端会话：打开会话时的查询发生在会话可用之前，使用主数据库
+            app = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///' + primary, READ_REPLICA=copy,
+                                  SESSION_BACKEND='server'))
+            client = app.test_client()
+            self.assertEqual(client.post('/login', data=dict(username='replica', password='123')).status_code, 302)
+            for _ in range(3):
+                self.assertEqual(client.get('/settings').status_code, 200)
+            self.assertIn('Before Snapshot', client.get('/').get_data(as_text=True))
+            with app.app_context():
+                db.session.remove()
+                db.engine.dispose()
+                app.extensions['watchlist_replica']['engine'].dispose()
+
+            # 以只读方式打开主数据库本身，GET 请求中无法写入
+            app = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///' + primary, READ_REPLICA='primary'))
+            with app.test_request_context('/'):
+                self.assertEqual(Movie.query.count(), 3)
+                self.assertRaises(OperationalError, db.session.execute, text('DELETE FROM movie'))
+                db.session.remove()
+            with app.test_request_context('/', method='POST'):
+                self.assertIs(db.session.get_bind(), db.engine)
+                db.session.remove()
+                db.engine.dispose()
+                app.extensions['watchlist_replica']['engine'].dispose()
+
+    # 测试静态文件构建：地址改写为带散列的文件名，使用长期缓存，并发送预先压缩的版本
+    def test_build_assets_command(self):
+        from Watchlist.assets import load_manifest, optional_module
+        with tempfile.TemporaryDirectory() as path:
+            static = os.path.join(path, 'static')
+            shutil.copytree(self.app.static_folder, static, ignore=shutil.ignore_patterns('dist'))
+            self.app.static_folder = static
+            result = self.runner.invoke(args=['build-assets'])
+            self.assertIn('Built 4 files', result.output)
+            self.app.extensions['watchlist_assets'] = load_manifest(static)
+
+            data = self.client.get('/').get_data(as_text=True)
+            css = re.search(r'href="(/static/dist/style\.\w{12}\.css)"', data).group(1)
+            response = self.client.get(css, headers={'Accept-Encoding': 'gzip'})
+            self.assertIn('immutable', response.headers['Cache-Control'])
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            with open(os.path.join(static, 'style.css'), 'rb') as f:
+                self.assertEqual(gzip.decompress(response.get_data()), f.read())
+            response.close()
+            response = self.client.get(css)
+            self.assertNotIn('Content-Encoding', response.headers)
+            response.close()
+
+            # 没有经过构建的地址仍然使用 Flask 默认的缓存策略
+            response = self.client.get('/static/style.css')
+            self.assertNotIn('immutable', response.headers.get('Cache-Control', ''))
+            response.close()
+            if optional_module('PIL.Image') is not None:
+                self.assertIn('<source type="image/webp"', data)
+                self.assertIn('80w', data)
+
+    # 测试预编译模板，以及新的程序实例启动时从字节码缓存加载全部模板
+    def test_compile_templates_command(self):
+        #默认只在 wsgi.py、asgi.py 中预热，命令行和测试创建的程序实例不预先加载模板
+        state = self.app.extensions['watchlist_warmup']
+        self.assertFalse(state['bytecode_cache'])
+        self.assertEqual(state['templates'], 0)
+        self.assertIsNotNone(state['startup_seconds'])
+        templates = len(self.app.jinja_env.list_templates())
+        with tempfile.TemporaryDirectory() as path:
+            directory = os.path.join(path, 'jinja')
+            self.app.config['TEMPLATE_CACHE_DIR'] = directory
+            result = self.runner.invoke(args=['compile-templates'])
+            self.assertIn('Compiled %d templates' % templates, result.output)
+            self.assertEqual(len(os.listdir(directory)), templates)
+
+            #模板全部来自缓存，启动预热时不再编译
+            with mock.patch('jinja2.Environment.compile', side_effect=AssertionError('compiled')):
+                app = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite://', TEMPLATE_CACHE_DIR=directory,
+                                      WARMUP_ON_START=True))
+            self.assertEqual(app.extensions['watchlist_warmup']['templates'], templates)
+            self.assertTrue(app.extensions['watchlist_warmup']['bytecode_cache'])
+            data = app.test_client().get('/metrics').get_data(as_text=True)
+            self.assertIn('watchlist_startup_seconds ', data)
+            self.assertIn('watchlist_template_bytecode_cache 1', data)
+
     # 测试生成管理员账户
     def test_admin_command(self):
         db.drop_all()
@@ -1,4 +1,4 @@
-#手动设置环境变量并导入app实例
+#手动设置环境变量并通过工厂函数创建app实例
 import os
 
 from dotenv import load_dotenv
@@ -6,5 +6,9 @@ from dotenv import load_dotenv
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 if os.path.exists(dotenv_path):
     load_dotenv(dotenv_path)
+#作为服务运行时在启动阶段预热，第一个请求不必编译模板（见 Watchlist/warmup.py）
+os.environ.setdefault('WARMUP_ON_START', '1')
 
-from Watchlist import app
\ No newline at end of file
+from Watchlist import create_app
+
+app = create_app()
\ No newline at end of file